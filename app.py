@@ -78,6 +78,7 @@ def init(name, **overrides):
     )
     # update validation field 'tp'
     slp.VALIDATION["tp"] = lambda value: value in slp.INPUT_TYPES
+    slp.VALIDATORS.clear()
     # create the SLP[i] global variables
     for slp_type in slp.JSON.ask("slp types"):
         setattr(slp, slp_type[1:].upper(), slp_type)
@@ -95,11 +96,50 @@ def init(name, **overrides):
     )
     # MONGO DB definitions
     dbapi.db = MongoClient(slp.JSON.get("mongo url", None))[database_name]
+    if not dbapi.check_transactions():
+        slp.LOG.warning(
+            "Database does not support transactions, state will be rebuilt "
+            "from journal after an interrupted write"
+        )
     dbapi.db.contracts.create_index("tokenId", unique=True)
     dbapi.db.journal.create_index([("height", 1), ("index", 1)], unique=True)
     dbapi.db.rejected.create_index([("height", 1), ("index", 1)], unique=True)
+    dbapi.db.unvalidated.create_index(
+        [("height", 1), ("index", 1)], unique=True
+    )
+    dbapi.db.unvalidated.create_index("blockStamp")
     dbapi.db.slp1.create_index([("address", 1), ("tokenId", 1)], unique=True)
     dbapi.db.slp2.create_index([("address", 1), ("tokenId", 1)], unique=True)
+    # indexes backing api queries
+    dbapi.db.contracts.create_index("owner")
+    dbapi.db.journal.create_index("txid")
+    # contracts left unapplied are looked up on each start
+    dbapi.db.journal.create_index("legit")
+    dbapi.db.journal.create_index([("id", 1), ("height", 1), ("index", 1)])
+    dbapi.db.journal.create_index(
+        [("emitter", 1), ("height", 1), ("index", 1)]
+    )
+    dbapi.db.slp1.create_index("tokenId")
+    dbapi.db.slp2.create_index("tokenId")
+    dbapi.db.token_stats.create_index("tokenId", unique=True)
+    dbapi.db.metadata.create_index("tokenId", unique=True)
+    # load proof of history tip from journal
+    dbapi.load_poh("journal")
+    # contracts that failed validation were stored in json files before
+    jsonfolder = os.path.join(slp.ROOT, ".json")
+    if os.path.isdir(jsonfolder):
+        dbapi.import_unvalidated(jsonfolder)
+    # backfill token stats of a database populated without them
+    if dbapi.db.token_stats.estimated_document_count() == 0 and \
+       dbapi.db.contracts.estimated_document_count() > 0:
+        slp.LOG.info("Building token stats...")
+        dbapi.build_token_stats()
+    if dbapi.db.metadata.estimated_document_count() == 0 and \
+       dbapi.db.slp2.estimated_document_count() > 0:
+        slp.LOG.info("Building metadata index...")
+        dbapi.build_metadata_index()
+    # load api peer health registry
+    sync.chain.load_peer_stats()
     # generate Decimal128 builders for all legit slp1 token
     for reccord in dbapi.db.journal.find(
         {"tp": "GENESIS", "slp_type": slp.SLP1, "legit": True}
@@ -108,6 +148,12 @@ def init(name, **overrides):
             lambda v, de=reccord.get('de', 0): Decimal128(f"%.{de}f" % v)
     # update peer limit in node module
     node.PEER_LIMIT = slp.JSON.get("peer limit", 10)
+    # bound block parser queue so sync slows down when parser lags
+    sync.chain.BlockParser.JOB.maxsize = slp.JSON.get(
+        "block queue size", 1000
+    )
+    # webhook blocks waiting for room in block parser queue
+    sync.chain.Feeder.JOB.maxsize = slp.JSON.get("webhook queue size", 10000)
 
 
 def clean(name):
@@ -120,6 +166,8 @@ def clean(name):
     dbapi.db.rejected.drop()
     dbapi.db.slp1.drop()
     dbapi.db.slp2.drop()
+    dbapi.db.token_stats.drop()
+    dbapi.db.metadata.drop()
     markfolder = os.path.join(slp.ROOT, ".json")
     markname = f"{slp.JSON['database name']}.mark"
     mark = slp.loadJson(markname, markfolder)
@@ -131,7 +179,10 @@ def clean(name):
 def reset(name):
     mark = clean(name)
     dbapi.db.journal.drop()
+    dbapi.db.unvalidated.drop()
+    dbapi.load_poh("journal")
     mark.pop("last parsed block", False)
+    mark.pop("last applied block", False)
     mark.pop("rebuild", False)
     markfolder = os.path.join(slp.ROOT, ".json")
     markname = f"{slp.JSON['database name']}.mark"
@@ -219,6 +270,7 @@ class SlpApp(srv.uJsonApp):
         sync.Processor.stop()
         node.Broadcaster.stop()
         msg.Messenger.stop()
+        sync.chain.Feeder.stop()
         sync.chain.BlockParser.stop()
 
 
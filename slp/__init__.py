@@ -4,6 +4,7 @@ import io
 import os
 import re
 import json
+import bisect
 import socket
 import logging
 import hashlib
@@ -18,27 +19,35 @@ LOG = logging.getLogger("slp")
 ROOT = os.path.abspath(os.path.dirname(__file__))
 BLOCKCHAIN_NODE = False
 REGEXP = re.compile(".*")
+PATTERNS = {
+    "id": re.compile(r"^(?:[0-9a-fA-F]{32}|[0-9a-fA-F]{64})$"),
+    "tx": re.compile(r"^[0-9a-fA-F]{64}$"),
+    "sy": re.compile(r"^[0-9a-zA-Z]{3,8}$"),
+    "na": re.compile(r"^.{3,24}$"),
+    "du": re.compile(
+        r"(https?|ipfs|ipns|dweb):\/\/[a-zA-Z0-9\/:%_+.,#?!@&=-]{3,180}"
+    ),
+    "no": re.compile(r"^.{0,180}$"),
+    "dt": re.compile(r"^.{0,256}$")
+}
 VALIDATION = {
-    "id": lambda value:
-        re.match(r"^[0-9a-fA-F]{32}$", value) is not None or
-        re.match(r"^[0-9a-fA-F]{64}$", value) is not None,
-    "tx": lambda value: re.match(r"^[0-9a-fA-F]{64}$", value) is not None,
+    "id": lambda value: PATTERNS["id"].match(value) is not None,
+    "tx": lambda value: PATTERNS["tx"].match(value) is not None,
     "qt": lambda value: isinstance(value, (int, float)),
     "de": lambda value: 0 <= value <= 8,
-    "sy": lambda value: re.match(r"^[0-9a-zA-Z]{3,8}$", value) is not None,
-    "na": lambda value: re.match(r"^.{3,24}$", value) is not None,
-    "du": lambda value: (value == "") or (
-        re.match(
-            r"(https?|ipfs|ipns|dweb):\/\/[a-zA-Z0-9\/:%_+.,#?!@&=-]{3,180}",
-            value
-        )
-    ) is not None,
-    "no": lambda value: re.match(r"^.{0,180}$", value) is not None,
+    "sy": lambda value: PATTERNS["sy"].match(value) is not None,
+    "na": lambda value: PATTERNS["na"].match(value) is not None,
+    "du": lambda value:
+        value == "" or PATTERNS["du"].match(value) is not None,
+    "no": lambda value: PATTERNS["no"].match(value) is not None,
     "pa": lambda value: value in [True, False, 0, 1],
     "mi": lambda value: value in [True, False, 0, 1],
     "ch": lambda value: isinstance(value, int),
-    "dt": lambda value: re.match(r"^.{0,256}$", value) is not None
+    "dt": lambda value: PATTERNS["dt"].match(value) is not None
 }
+# compiled validators by slp fields set, has to be cleared if VALIDATION is
+# updated
+VALIDATORS = {}
 
 #: headers sent from with all python-slp HTTP requests
 HEADERS = {
@@ -48,12 +57,50 @@ HEADERS = {
 }
 
 
+def compile_validator(slp_fields):
+    """
+    Build a validator restricted to a set of slp fields. Validator returns
+    `None` if all fields pass, else a reason dict about the first failing
+    field.
+    """
+    checks = dict([k, VALIDATION[k]] for k in slp_fields if k in VALIDATION)
+
+    def validator(**fields):
+        for key, value in fields.items():
+            test = checks.get(key, None)
+            if test is None:
+                continue
+            try:
+                if test(value):
+                    continue
+                reason = "invalid value"
+            except Exception as error:
+                reason = f"{error.__class__.__name__}: {error}"
+            return {"field": key, "value": value, "reason": reason}
+        return None
+
+    return validator
+
+
+def check(fields, height=None):
+    """
+    Check fields against the validator of the milestone applying at a
+    specific height.
+
+    Returns:
+        dict: reason of the first failure or `None` if fields are valid.
+    """
+    slp_fields = tuple(JSON.ask("slp fields", height))
+    validator = VALIDATORS.get(slp_fields, None)
+    if validator is None:
+        validator = VALIDATORS[slp_fields] = compile_validator(slp_fields)
+    reason = validator(**fields)
+    LOG.debug("validation result: %s", reason or "passed")
+    return reason
+
+
 def validate(**fields):
-    tests = dict(
-        [k, VALIDATION[k](v)] for k, v in fields.items() if k in VALIDATION
-    )
-    LOG.debug("validation result: %s", tests)
-    return list(tests.values()).count(False) == 0
+    return check(fields) is None
 
 
 def get_extern_ip():
@@ -86,8 +133,14 @@ def dumpJson(data, name, folder=None):
         os.makedirs(os.path.dirname(filename))
     except OSError:
         pass
-    with io.open(filename, "w", encoding="utf-8") as out:
+    # write to a temporary file and swap it with destination so a crash
+    # never leaves a truncated json file
+    tmpname = f"{filename}.tmp"
+    with io.open(tmpname, "w", encoding="utf-8") as out:
         json.dump(data, out, indent=4)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmpname, filename)
 
 
 def get_token_id(slp_type, symbol, blockheight, txid):
@@ -139,22 +192,44 @@ class Config(dict):
 
         self.clear()
         self.update(dict(data, **overrides))
+        self.index()
+
+    def index(self):
+        """
+        Build sorted milestone heights and their resolved views so a
+        milestone is found with a bisection.
+        """
+        milestones = dict.__getitem__(self, "milestones")
+        self._heights = sorted(milestones.keys())
+        self._views = [milestones[h] for h in self._heights]
+        # last resolved interval: lower height, upper height, view
+        self._last = (None, None, None)
+
+    def milestone(self, height=None):
+        """
+        Return the milestone view applying at a specific height.
+        """
+        if height is None:
+            return self._views[-1]
+        low, high, view = self._last
+        if low is not None and low <= height < high:
+            return view
+        i = bisect.bisect_right(self._heights, height) - 1
+        if i < 0:
+            raise Exception("value not found in milestones")
+        view = self._views[i]
+        self._last = (
+            self._heights[i],
+            self._heights[i+1] if i+1 < len(self._heights) else float("inf"),
+            view
+        )
+        return view
 
     def ask(self, key, height=None):
         if key in self:
             return dict.__getitem__(self, key)
         else:
-            if height is None:
-                height = max(dict.__getitem__(self, "milestones").keys())
-            else:
-                try:
-                    height = [
-                        h for h in dict.__getitem__(self, "milestones")
-                        if h <= height
-                    ][-1]
-                except Exception:
-                    raise Exception("value not found in milestones")
-            return dict.__getitem__(self, "milestones").get(height, {})[key]
+            return self.milestone(height)[key]
 
 
 JSON = Config()
@@ -3,11 +3,15 @@
 # TODO: https://editor.swagger.io/
 
 import slp
+import json
 import math
+import base64
+import threading
 import traceback
-import functools
+import collections
 
 from usrv import srv
+from bson import json_util
 from slp import dbapi, serde
 
 DECIMAL128_FIELDS = "balance,minted,burned,exited,crossed," \
@@ -15,7 +19,129 @@ DECIMAL128_FIELDS = "balance,minted,burned,exited,crossed," \
 OPERATOR_FIELDS = "balance,minted,burned,crossed,globalSupply,qt".split(",")
 SEARCH_FIELDS = "address,tokenId,blockStamp,owner,frozen," \
                 "slp_type,emitter,receiver,legit,tp,sy,id,pa,mi," \
-                "height,index,type,paused,symbol".split(",")
+                "height,index,type,paused,symbol,txid".split(",")
+#: unique indexed keys by collection, used as pagination tie breakers
+UNIQUE_KEYS = {
+    "journal": ["height", "index"],
+    "rejected": ["height", "index"],
+    "unvalidated": ["height", "index"],
+    "contracts": ["tokenId"],
+    "slp1": ["address", "tokenId"],
+    "slp2": ["address", "tokenId"]
+}
+
+#: decoded metadata by packed value, see unpack_meta
+METADATA = collections.OrderedDict()
+METADATA_LOCK = threading.Lock()
+
+
+def unpack_meta(data):
+    """
+    Decode packed metadata. Decoded values are kept in a LRU cache of
+    `metadata cache size` entries.
+    """
+    data = bytes(data)
+    with METADATA_LOCK:
+        if data in METADATA:
+            METADATA.move_to_end(data)
+            return dict(METADATA[data])
+    value = serde._unpack_meta(data)
+    with METADATA_LOCK:
+        METADATA[data] = value
+        while len(METADATA) > slp.JSON.get("metadata cache size", 1000):
+            METADATA.popitem(last=False)
+    return dict(value)
+
+
+def token_metadata(tokenId):
+    """
+    Merged metadata of an SLP2 token.
+    """
+    index = dbapi.db.metadata.find_one({"tokenId": tokenId})
+    return {} if index is None else unpack_meta(index["metadata"])
+
+
+def encode_cursor(document, sort):
+    """
+    Build an opaque continuation token from the sort key of a document.
+    """
+    return base64.urlsafe_b64encode(
+        json_util.dumps([document.get(field) for field, order in sort])
+        .encode("utf-8")
+    ).decode("utf-8").rstrip("=")
+
+
+def decode_cursor(token, sort):
+    """
+    Build the filter selecting documents sorted after a continuation token.
+    Raises `ValueError` if token does not match sort key.
+    """
+    try:
+        values = json_util.loads(
+            base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        )
+    except Exception:
+        values = None
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise ValueError("invalid continuation token %s" % token)
+    clauses = []
+    for i, (field, order) in enumerate(sort):
+        clause = dict([sort[j][0], values[j]] for j in range(i))
+        # null and missing values sort before any other value and are not
+        # selected by $gt or $lt comparisons
+        if values[i] is None:
+            if order < 0:
+                continue
+            clause[field] = {"$ne": None}
+        elif order > 0:
+            clause[field] = {"$gt": values[i]}
+        else:
+            clause["$or"] = [{field: {"$lt": values[i]}}, {field: None}]
+        clauses.append(clause)
+    return {"$or": clauses} if len(clauses) else {"_id": {"$exists": False}}
+
+
+def paginate(
+    col, filters, sort=(), page=1, limit=100, after=None, count="exact"
+):
+    """
+    Return a page of documents and its meta data. If `after` continuation
+    token is given, page is selected on sort key instead of skipping
+    previous documents. `count` can be `exact`, `estimated` (only applies
+    to unfiltered requests) or `none`.
+    """
+    # sort key has to identify a single document, use _id as tie breaker if
+    # it does not contain a unique index of the collection
+    sort = list(sort)
+    fields = [field for field, order in sort]
+    unique = UNIQUE_KEYS.get(col.name, ["_id"])
+    if "_id" not in fields and not set(unique) <= set(fields):
+        sort.append(("_id", 1))
+
+    if after is not None:
+        # raises ValueError on malformed token
+        cursor = col.find({"$and": [filters, decode_cursor(after, sort)]})
+        cursor = cursor.sort(sort)
+    else:
+        cursor = col.find(filters).sort(sort).skip((page-1) * limit)
+    documents = list(cursor.limit(limit))
+
+    if count == "none":
+        total = None
+    elif count == "estimated" and not len(filters):
+        total = col.estimated_document_count()
+    else:
+        total = col.count_documents(filters)
+
+    return documents, {
+        "count": len(documents),
+        "totalCount": total,
+        "page": page if after is None else None,
+        "pageCount": None if total is None else
+        int(math.ceil(total / float(limit))),
+        "next": encode_cursor(documents[-1], sort)
+        if len(documents) == limit else None
+    }
 
 
 def find(collection, **kw):
@@ -25,6 +151,8 @@ def find(collection, **kw):
     # pop pagination keys
     orderBy = kw.pop("orderBy", None)
     page = int(kw.pop("page", 1))
+    after = kw.pop("after", None)
+    count = kw.pop("count", "exact")
 
     # filter kw so that only database specified keys can be search on.
     # it also gets rid of request environ (headers, environ, data...)
@@ -55,46 +183,36 @@ def find(collection, **kw):
     for key in [k for k in ["height", "index"] if k in filters]:
         filters[key] = int(filters[key])
 
-    # computes count and execute first filter
-    total = col.count_documents(filters)
-    pages = int(math.ceil(total / 100.))
-    cursor = col.find(filters)
-
     # apply ordering
+    sort = []
     if orderBy is not None:
-        cursor = cursor.sort(
-            tuple(
-                [field, -1 if order.lower() in ["desc", "reversed"] else 1]
-                for field, order in [
-                    (order_by + (":" if ":" not in order_by else ""))
-                    .split(":") for order_by in orderBy.split(",")
-                ]
-            )
+        sort = [
+            (field, -1 if order.lower() in ["desc", "reversed"] else 1)
+            for field, order in [
+                (order_by + (":" if ":" not in order_by else ""))
+                .split(":") for order_by in orderBy.split(",")
+            ]
+        ]
+
+    # jump to asked page or continuation token
+    try:
+        reccords, meta = paginate(
+            col, filters, sort, page, 100, after, count
         )
-
-    # jump to asked page
-    cursor = cursor.skip((page-1) * 100)
+    except ValueError as error:
+        return {"status": 400, "msg": "%s" % error}
 
     # build data
     data = []
-    for reccord in list(cursor.limit(100)):
+    for reccord in reccords:
         reccord.pop("_id", False)
         if "metadata" in reccord:
-            reccord["metadata"] = serde._unpack_meta(reccord["metadata"])
+            reccord["metadata"] = unpack_meta(reccord["metadata"])
         for key in [k for k in DECIMAL128_FIELDS if k in reccord]:
             reccord[key] = float(reccord[key].to_decimal())
         data.append(reccord)
 
-    return {
-        "status": 200,
-        "meta": {
-            "count": len(data),
-            "totalCount": total,
-            "page": page,
-            "pageCount": pages
-        },
-        "data": data
-    }
+    return {"status": 200, "meta": meta, "data": data}
 
 
 ################
@@ -132,33 +250,28 @@ def status():
     }
 
 
-@srv.bind("/api/tokens", methods=["GET"], app=srv.uJsonHandler)
-def tokens(page=1, limit=50):
-    page = int(page)
-    limit = int(limit)
-    # computes count and execute first filter
-    total = dbapi.db.contracts.count_documents({})
-    cursor = dbapi.db.contracts.find({})
-    pages = int(math.ceil(total / float(limit)))
-    # jump to asked page
-    cursor = cursor.skip((page-1) * limit)
-
-    data = functools.reduce(
-        lambda a, b: a + b, [
-            list(dbapi.token_details(contract["tokenId"]))
-            for contract in cursor.limit(min(50, limit))
-        ], []
+def page_details(contracts):
+    """
+    Token details of a contract page, in page order.
+    """
+    order = dict([c["tokenId"], i] for i, c in enumerate(contracts))
+    return sorted(
+        dbapi.token_details(*order),
+        key=lambda t: order[t["tokenDetails"]["tokenIdHex"]]
     )
-    return {
-        "status": 200,
-        "meta": {
-            "count": len(data),
-            "totalCount": total,
-            "page": page,
-            "pageCount": pages
-        },
-        "data": data
-    }
+
+
+@srv.bind("/api/tokens", methods=["GET"], app=srv.uJsonHandler)
+def tokens(page=1, limit=50, after=None, count="exact"):
+    try:
+        contracts, meta = paginate(
+            dbapi.db.contracts, {}, page=int(page),
+            limit=min(50, int(limit)), after=after, count=count
+        )
+    except ValueError as error:
+        return {"status": 400, "msg": "%s" % error}
+    data = page_details(contracts)
+    return {"status": 200, "meta": dict(meta, count=len(data)), "data": data}
 
 
 @srv.bind("/api/token/<str:tokenId>", methods=["GET"], app=srv.uJsonHandler)
@@ -167,13 +280,9 @@ def token(tokenId):
     if len(token):
         token = token[0]
         if token["type"][-1] in ["2", ]:
-            metadata = {}
-            for reccord in [
-                r for r in dbapi.db.slp2.find()
-                if "metadata" in r
-            ]:
-                metadata.update(serde._unpack_meta(reccord["metadata"]))
-            token["metadata"] = metadata
+            token["metadata"] = token_metadata(
+                token["tokenDetails"]["tokenIdHex"]
+            )
         return token
     else:
         return {"status": 400, "msg": "token %s not found" % tokenId}
@@ -188,13 +297,9 @@ def token_by_txid(txId):
     if len(token):
         token = token[0]
         if token["type"][-1] in ["2", ]:
-            metadata = {}
-            for reccord in [
-                r for r in dbapi.db.slp2.find()
-                if "metadata" in r
-            ]:
-                metadata.update(serde._unpack_meta(reccord["metadata"]))
-            token["metadata"] = metadata
+            token["metadata"] = token_metadata(
+                token["tokenDetails"]["tokenIdHex"]
+            )
         return token
     else:
         return {"status": 400, "msg": "token %s not found" % reccord["id"]}
@@ -203,80 +308,60 @@ def token_by_txid(txId):
 @srv.bind(
     "/api/tokensByOwner/<str:addr>", methods=["GET"], app=srv.uJsonHandler
 )
-def tokens_by_owner(addr, page=1, limit=50):
-    page = int(page)
-    limit = int(limit)
-    # computes count and execute first filter
-    total = dbapi.db.contracts.count_documents({'owner': addr})
-    cursor = dbapi.db.contracts.find({'owner': addr})
-    pages = int(math.ceil(total / float(limit)))
-    # jump to asked page
-    cursor = cursor.skip((page-1) * limit)
-
-    data = functools.reduce(
-        lambda a, b: a + b, [
-            list(dbapi.token_details(contract["tokenId"]))
-            for contract in cursor.limit(min(100, limit))
-        ], []
+def tokens_by_owner(addr, page=1, limit=50, after=None, count="exact"):
+    try:
+        contracts, meta = paginate(
+            dbapi.db.contracts, {'owner': addr}, page=int(page),
+            limit=min(100, int(limit)), after=after, count=count
+        )
+    except ValueError as error:
+        return {"status": 400, "msg": "%s" % error}
+    data = page_details(contracts)
+    return {"status": 200, "meta": dict(meta, count=len(data)), "data": data}
+
+
+def aggregate_page(aggregation, page=1, limit=100, count="exact", **kw):
+    """
+    Run a paginated `dbapi` aggregation and build the api response. Total
+    count is computed in the same aggregation unless `count` is `none`.
+    """
+    page, limit = int(page), min(100, int(limit))
+    cursor = aggregation(
+        skip=(page-1) * limit, limit=limit, count=count != "none", **kw
     )
+    if count == "none":
+        data, total = list(cursor), None
+    else:
+        result = next(cursor, {"data": [], "total": []})
+        data = result["data"]
+        total = result["total"][0]["count"] if len(result["total"]) else 0
     return {
         "status": 200,
         "meta": {
             "count": len(data),
             "totalCount": total,
             "page": page,
-            "pageCount": pages
+            "pageCount": None if total is None else
+            int(math.ceil(total / float(limit)))
         },
         "data": data
     }
 
 
 @srv.bind("/api/addresses", methods=["GET"], app=srv.uJsonHandler)
-def addresses(page=1, limit=100, **kw):
-    page = int(page)
-    limit = int(limit)
-    # computes count and execute first filter
-    aggregation = list(dbapi.wallets(tokenId=kw.get("tokenId", None)))
-    total = len(aggregation)
-    pages = int(math.ceil(total / float(limit)))
-    # jump to asked page
-    start = (page-1) * limit
-    data = aggregation[start:start + min(100, limit)]
-    return {
-        "status": 200,
-        "meta": {
-            "count": len(data),
-            "totalCount": total,
-            "page": page,
-            "pageCount": pages
-        },
-        "data": data
-    }
+def addresses(page=1, limit=100, count="exact", **kw):
+    return aggregate_page(
+        dbapi.wallets, page, limit, count, tokenId=kw.get("tokenId", None)
+    )
 
 
 @srv.bind(
     "/api/addresses/<str:address>", methods=["GET"], app=srv.uJsonHandler
 )
-def address(address, page=1, limit=100):
-    page = int(page)
-    limit = int(limit)
-    # computes count and execute first filter
-    aggregation = list(dbapi.wallets(address))
-    total = len(aggregation)
-    pages = int(math.ceil(total / float(limit)))
-    # jump to asked page
-    start = (page-1) * limit
-    data = aggregation[start:start + min(100, limit)]
-    return {
-        "status": 200,
-        "meta": {
-            "count": len(data),
-            "totalCount": total,
-            "page": page,
-            "pageCount": pages
-        },
-        "data": data
-    }
+def address(address, page=1, limit=100, count="exact"):
+    return aggregate_page(
+        dbapi.wallets, page, limit, count, address=address
+    )
 
 
 @srv.bind(
@@ -292,31 +377,11 @@ def balance(address, tokenId):
 
 
 @srv.bind("/api/transactions", methods=["GET"], app=srv.uJsonHandler)
-def transactions(page=1, limit=100, **kw):
-    page = int(page)
-    limit = int(limit)
-    # computes count and execute first filter
-    aggregation = list(
-        dbapi.transactions(
-            tokenId=kw.get("tokenId", None),
-            address=kw.get("address", None)
-        )
+def transactions(page=1, limit=100, count="exact", **kw):
+    return aggregate_page(
+        dbapi.transactions, page, limit, count,
+        tokenId=kw.get("tokenId", None), address=kw.get("address", None)
     )
-    total = len(aggregation)
-    pages = int(math.ceil(total / float(limit)))
-    # jump to asked page
-    start = (page-1) * limit
-    data = aggregation[start:start + min(100, limit)]
-    return {
-        "status": 200,
-        "meta": {
-            "count": len(data),
-            "totalCount": total,
-            "page": page,
-            "pageCount": pages
-        },
-        "data": data
-    }
 
 
 @srv.bind(
@@ -330,9 +395,62 @@ def transaction(txid):
         return {"status": 400, "msg": "tx %s not found" % txid}
 
 
-# "/metadata/{txid}"
-# "/metadata/{tokenid}"
-# "/metadata/{tokenid}/{address}"
+@srv.bind("/api/unvalidated", methods=["GET"], app=srv.uJsonHandler)
+def unvalidated(**kw):
+    # contracts rejected by field validation, use blockStamp=height#index
+    # (url-encoded), height, txid, slp_type or tp to filter
+    try:
+        return find("unvalidated", **kw)
+    except Exception as error:
+        slp.LOG.error(
+            "Error trying to fetch data : %s\n%s", kw, traceback.format_exc()
+        )
+        return {"status": 501, "msg": "Internal Error: %r" % error}
+
+
+@srv.bind("/api/metadata/<str:id>", methods=["GET"], app=srv.uJsonHandler)
+def metadata(id):
+    # a transaction id gives the metadata written by an ADDMETA contract,
+    # else id is a token id (both may be 64 hex characters long) and merged
+    # token metadata is returned
+    reccord = dbapi.db.journal.find_one({"txid": id})
+    if reccord is not None:
+        if reccord.get("tp", None) != "ADDMETA":
+            return {"status": 400, "msg": "%s is not an ADDMETA contract" % id}
+        try:
+            if reccord.get("na", None) not in [None, "", False]:
+                data = {reccord["na"]: reccord["dt"]}
+            else:
+                data = json.loads(reccord["dt"])
+        except Exception as error:
+            return {"status": 400, "msg": "%r" % error}
+        return {
+            "status": 200, "tokenId": reccord["id"],
+            "legit": reccord["legit"], "data": data
+        }
+    contract = dbapi.db.contracts.find_one({"tokenId": id})
+    if contract is None or contract["type"][-1] not in ["2", ]:
+        return {"status": 400, "msg": "SLP2 token %s not found" % id}
+    return {"status": 200, "tokenId": id, "data": token_metadata(id)}
+
+
+@srv.bind(
+    "/api/metadata/<str:tokenId>/<str:address>",
+    methods=["GET"], app=srv.uJsonHandler
+)
+def wallet_metadata(tokenId, address):
+    wallet = dbapi.db.slp2.find_one({"address": address, "tokenId": tokenId})
+    if wallet is None:
+        return {
+            "status": 400,
+            "msg": "wallet %s not found for token %s" % (address, tokenId)
+        }
+    return {
+        "status": 200, "tokenId": tokenId, "address": address,
+        "blockStamp": wallet["blockStamp"],
+        "data": unpack_meta(wallet["metadata"])
+    }
+
 
 ####################
 # SMARTBRIDGES API #
@@ -35,6 +35,7 @@ import os
 import sys
 import slp
 import json
+import time
 import queue
 import random
 import pickle
@@ -42,33 +43,185 @@ import hashlib
 import importlib
 import traceback
 import threading
+import collections
+import concurrent.futures
 
-from slp import serde, dbapi
+from slp import serde, dbapi, client
 from usrv import req
+from pymongo.errors import PyMongoError
+
+#: number of transactions rejected by each vendor field parsing stage
+FUNNEL = collections.Counter()
+FUNNEL_LOCK = threading.Lock()
+#: vendor field prefixes computed once per slp types selection
+PREFIXES = {}
+#: transaction order within a block, it sets contract indexes so block and
+#: range downloads have to request the same one
+TX_ORDER = "sequence:asc"
+#: api peer health registry, persisted between runs
+PEER_STATS = {}
+PEER_LOCK = threading.Lock()
+
+
+class Meter:
+    """
+    Event counter with an exponentially weighted rate in events per second.
+    """
 
+    def __init__(self, halflife=10.):
+        self.halflife = halflife
+        self.lock = threading.Lock()
+        self.count = 0
+        self.pending = 0
+        self.value = 0.
+        self.last = time.time()
+
+    def _tick(self):
+        now = time.time()
+        elapsed = now - self.last
+        if elapsed >= 1.:
+            alpha = 1. - 0.5 ** (elapsed / self.halflife)
+            self.value += alpha * (self.pending / elapsed - self.value)
+            self.pending = 0
+            self.last = now
+
+    def mark(self, n=1):
+        with self.lock:
+            self._tick()
+            self.count += n
+            self.pending += n
+
+    def rate(self):
+        with self.lock:
+            self._tick()
+            return self.value
+
+
+#: block pipeline meters
+ENQUEUED = Meter()
+DRAINED = Meter()
+
+
+def _errors(stats, now):
+    # error rate fades out with time since last sample so a peer ranked
+    # last, thus rarely requested, gets its chance again
+    elapsed = max(0., now - stats.get("sampled", 0.))
+    return stats.get("errors", 0.) * 0.5 ** (
+        elapsed / slp.JSON.get("peer error halflife", 600.)
+    )
 
-def select_peers():
-    peers = []
-    try:
-        # here candadates is at least [slp.JSON["api peer"]], so if default api
-        # peer does not respond, it should loop until api peer is back
-        candidates = req.GET.api.peers(
-            peer=slp.JSON["api peer"], orderBy="height:desc",
-            headers=slp.HEADERS
-        ).get("data", [slp.JSON["api peer"]])
-    except Exception:
-        # in case of any HTTP error set peers to [slp.JSON["api peer"]]
-        slp.LOG.error("Can not fetch peers from %s", slp.JSON["api peer"])
-        peers = [slp.JSON["api peer"]]
+
+def record_peer(peer, latency=None, failed=False, height=None):
+    """
+    Update api peer health. Latency and error rate are exponentially
+    weighted over requests, error rate decaying with time between them.
+
+    Args:
+        peer (str): peer url.
+        latency (float): response time of a successful request.
+        failed (bool): request failed.
+        height (int): last known peer height.
+    """
+    with PEER_LOCK:
+        stats = PEER_STATS.setdefault(
+            peer, {"latency": None, "errors": 0., "height": 0}
+        )
+        if height is not None:
+            stats["height"] = height
+        if failed or latency is not None:
+            now = time.time()
+            errors = _errors(stats, now)
+            stats["errors"] = errors + 0.2 * ((1. if failed else 0.) - errors)
+            stats["sampled"] = now
+        if latency is not None:
+            stats["latency"] = latency if stats["latency"] is None else \
+                stats["latency"] + 0.2 * (latency - stats["latency"])
+
+
+def peer_score(peer, top_height):
+    """
+    Return `(healthy, score)` of an api peer, lower score is better. Peers
+    never requested get a default latency so they are tried too.
+    """
+    with PEER_LOCK:
+        stats = dict(PEER_STATS.get(peer, {}))
+    latency = stats.get("latency", None) or 0.5
+    errors = _errors(stats, time.time())
+    lag = max(0, top_height - stats.get("height", top_height))
+    healthy = errors < slp.JSON.get("peer max error rate", 0.5) and \
+        lag <= slp.JSON.get("peer max lag", 5)
+    return healthy, latency * (1. + 4. * errors) * (1. + lag)
+
+
+def api_get(peer, *path, **kw):
+    """
+    GET request to an api peer, recording its latency and errors.
+    """
+    start = time.time()
+    resp = client.get(peer, *path, **kw)
+    if "error" in resp or resp.get("status", 500) >= 500:
+        record_peer(peer, failed=True)
     else:
-        for candidate in candidates[:20]:
-            api_port = candidate.get("ports", {}).get(
-                "@arkecosystem/core-api", -1
-            )
-            if api_port > 0:
-                peers.append("http://%s:%s" % (candidate["ip"], api_port))
-    finally:
-        return peers
+        record_peer(peer, latency=time.time() - start)
+    return resp
+
+
+def load_peer_stats():
+    PEER_STATS.update(
+        slp.loadJson(
+            f"{slp.JSON['database name']}.peers",
+            os.path.join(slp.ROOT, ".json")
+        )
+    )
+
+
+def save_peer_stats():
+    with PEER_LOCK:
+        data = dict([k, dict(v)] for k, v in PEER_STATS.items())
+    try:
+        slp.dumpJson(
+            data, f"{slp.JSON['database name']}.peers",
+            os.path.join(slp.ROOT, ".json")
+        )
+    except Exception as error:
+        slp.LOG.error("peer stats not saved: %r", error)
+
+
+def select_peers():
+    """
+    Return api peers sorted by health: peers with low error rate and height
+    lag first, then fastest first. Default api peer is returned if no peer
+    can be fetched.
+    """
+    api_peer = slp.JSON["api peer"]
+    candidates = api_get(
+        api_peer, "api", "peers", orderBy="height:desc", headers=slp.HEADERS
+    ).get("data", [])
+    heights = {}
+    for candidate in candidates[:slp.JSON.get("peer candidates", 20)]:
+        api_port = candidate.get("ports", {}).get(
+            "@arkecosystem/core-api", -1
+        )
+        if api_port > 0:
+            heights["http://%s:%s" % (candidate["ip"], api_port)] = \
+                candidate.get("height", 0)
+    if not len(heights):
+        # here default api peer is returned, so if it does not respond, it
+        # should loop until api peer is back
+        slp.LOG.error("Can not fetch peers from %s", api_peer)
+        return [api_peer]
+    for peer, height in heights.items():
+        record_peer(peer, height=height)
+    top_height = max(heights.values())
+    scores = dict([p, peer_score(p, top_height)] for p in heights)
+    peers = sorted(heights, key=lambda p: (not scores[p][0], scores[p][1]))
+    slp.LOG.debug(
+        "peer selection: %s",
+        ["%s %.3f%s" % (p, scores[p][1], "" if scores[p][0] else " (sick)")
+         for p in peers]
+    )
+    save_peer_stats()
+    return peers
 
 
 def subscribed():
@@ -203,24 +356,129 @@ def get_block_transactions(blockId, peer=None):
     data, page, result = [None], 1, []
     peer = peer or slp.JSON["api peer"]
     while len(data) > 0:
-        data = req.GET.api.blocks(
-            blockId, "transactions", page=page, peer=peer, headers=slp.HEADERS
+        data = api_get(
+            peer, "api", "blocks", blockId, "transactions", page=page,
+            orderBy=TX_ORDER, headers=slp.HEADERS
         ).get("data", [])
         result += data
         page += 1
     return result
 
 
-def read_vendorField(vendorField, height=None):
-    contract = False
-    try:
-        contract = json.loads(vendorField)
-    except Exception:
+def get_range_transactions(start, end, peer=None):
+    """
+    Download all transactions from a height range and group them by block id.
+    Returns `None` if peer is not able to answer the range query.
+    """
+    page, result = 1, {}
+    peer = peer or slp.JSON["api peer"]
+    while True:
+        resp = api_get(
+            peer, "api", "transactions", page=page, limit=100,
+            headers=slp.HEADERS, orderBy=f"blockHeight:asc,{TX_ORDER}",
+            **{"blockHeight.from": start, "blockHeight.to": end}
+        )
+        if resp.get("status", False) != 200:
+            return None
+        data = resp.get("data", [])
+        for tx in data:
+            result.setdefault(tx["blockId"], []).append(tx)
+        if len(data) == 0 or resp.get("meta", {}).get("next", None) is None:
+            return result
+        page += 1
+
+
+def funnel(stage, n=1):
+    with FUNNEL_LOCK:
+        FUNNEL[stage] += n
+
+
+def enqueue(block, stop=None, timeout=1.):
+    """
+    Put a block into BlockParser queue. If queue is full, caller is blocked
+    until BlockParser drains it or until `stop` event is set.
+
+    Returns:
+        bool: `True` if block was queued.
+    """
+    while True:
         try:
-            contract = serde.unpack_slp(vendorField, height)
-        except Exception:
-            pass
-    return False or contract
+            BlockParser.JOB.put(block, timeout=timeout)
+        except queue.Full:
+            if stop is not None and stop.is_set():
+                return False
+        else:
+            ENQUEUED.mark()
+            return True
+
+
+def gauges():
+    """
+    Block pipeline gauges: queue depth and enqueue/drain rates.
+    """
+    return {
+        "queue depth": BlockParser.JOB.qsize(),
+        "queue size": BlockParser.JOB.maxsize,
+        "enqueued": ENQUEUED.count,
+        "drained": DRAINED.count,
+        "enqueue rate": round(ENQUEUED.rate(), 3),
+        "drain rate": round(DRAINED.rate(), 3)
+    }
+
+
+def get_prefixes(height=None):
+    """
+    Return serialized and json prefixes an SLP vendor field may start with.
+    Serialized prefixes are the ones accepted by `serialized regex`.
+    """
+    slp_types = tuple(slp.JSON.ask("slp types", height))
+    if slp_types not in PREFIXES:
+        PREFIXES[slp_types] = (
+            tuple(
+                f"{slp_type}://" for slp_type in slp_types
+                if slp.REGEXP.match(f"{slp_type}://") is not None
+            ),
+            tuple(f'"{slp_type}"' for slp_type in slp_types)
+        )
+    return PREFIXES[slp_types]
+
+
+def read_vendorFields(vendorFields, height=None):
+    """
+    Read SLP contracts from vendor fields of a same block. Serialized
+    contracts are unpacked in a single batch. Returns a list of contracts with
+    `False` where vendor field is not an SLP contract.
+    """
+    serialized, jsonified = get_prefixes(height)
+    result, smartbridges = [], []
+    funnel("read", len(vendorFields))
+    for vendorField in vendorFields:
+        if vendorField.startswith(serialized):
+            smartbridges.append((len(result), vendorField))
+            result.append(False)
+        elif vendorField.lstrip().startswith("{") and \
+                any(slp_type in vendorField for slp_type in jsonified):
+            try:
+                result.append(json.loads(vendorField))
+            except Exception:
+                funnel("json")
+                result.append(False)
+        else:
+            funnel("prefix")
+            result.append(False)
+    if len(smartbridges):
+        for (i, smartbridge), contract in zip(
+            smartbridges,
+            serde.unpack_many([s for n, s in smartbridges], height)
+        ):
+            if contract is False:
+                funnel("serialized")
+            result[i] = contract
+    return result
+
+
+def read_vendorField(vendorField, height=None):
+    return read_vendorFields([vendorField], height)[0]
 
 
 def manage_block(**request):
@@ -247,20 +505,50 @@ def manage_block(**request):
         "unix": timestamp,
     }
     block["transactions"] = block.pop("numberOfTransactions")
-    # push block into queue to be parsed
-    BlockParser.JOB.put(block)
+    # hand block over to Feeder, messenger thread must not be blocked by a
+    # lagging BlockParser
+    try:
+        Feeder.JOB.put_nowait(block)
+    except queue.Full:
+        miss_block(block)
+        return False
+    return True
 
 
-def parse_block(block, peer=None):
+def miss_block(block):
     """
-    Search valid SLP vendor fields in all transactions from specified block.
-    If any, it is normalized and registered as a rreccord in journal.
+    Record a webhook block that could not be queued. On next start,
+    synchronization resumes below the lowest missed block.
+    """
+    height = block.get("height", 0)
+    slp.LOG.error(
+        "Block %s not queued, it will be synchronized on next start", height
+    )
+    mark = Feeder.CHECKPOINT
+    if mark is None:
+        return False
+    missed = mark.get("missed block", None)
+    if missed is None or height < missed:
+        mark.update(**{"missed block": height})
+    return mark.save(force=True)
+
+
+def decode_block(block, peer=None):
+    """
+    Download transactions from specified block and decode SLP contracts
+    found in vendor fields. Decoding does not depend on database state so
+    blocks can be decoded concurrently.
+
+    Returns:
+        list: `(index, txid, slp_type, fields)` tuples in transaction order.
     """
-    # contracts to be returned
-    contracts = []
+    decoded = []
     # get transactions from block
     nb_tx = int(block["transactions"])
-    tx_list = get_block_transactions(block["id"], peer)
+    # transactions could have been prefetched by sync.Prefetcher
+    tx_list = block.pop("tx_list", None)
+    if tx_list is None:
+        tx_list = get_block_transactions(block["id"], peer)
     # because at some point, peer could return nothing good, check the
     # transaction count, AssertionError will be managed by BlockParser
     try:
@@ -270,17 +558,22 @@ def parse_block(block, peer=None):
         raise Exception("Block integrity breach")
     loop = zip(list(range(len(tx_list))), tx_list)
     # search for SLP vendor fields in transfer type transactions
-    for index, tx in [
+    candidates = [
         (i+1, t) for i, t in loop
         if t["type"] == 0 and
         t.get("vendorField", "") != ""
-    ]:
-        # try to read contract from vendor field
-        contract = read_vendorField(tx["vendorField"], height=block["height"])
+    ]
+    # try to read contracts from vendor fields
+    for (index, tx), contract in zip(
+        candidates, read_vendorFields(
+            [t["vendorField"] for i, t in candidates], height=block["height"]
+        )
+    ):
         if contract:
             try:
                 slp_type, fields = list(contract.items())[0]
                 if slp_type not in slp.JSON.ask("slp types", block["height"]):
+                    funnel("slp type")
                     slp.LOG.info("> unknown SLP contract found: %s", slp_type)
                     raise Exception("unknown SLP contract %s" % slp_type)
                 slp.LOG.info(
@@ -292,14 +585,6 @@ def parse_block(block, peer=None):
                 fields["timestamp"] = timestamp + interval * int(index)
                 # compute token id for GENESIS contracts
                 if fields["tp"] == "GENESIS":
-                    if fields["sy"] in slp.JSON.ask(
-                        "denied tickers"
-                    ) or dbapi.find_reccord(
-                        sy=fields["sy"], legit=True
-                    ) is not None:
-                        raise Exception(
-                            "'%s' ticker is denied..." % fields["sy"]
-                        )
                     fields.update(id=slp.get_token_id(
                         slp_type, fields["sy"], block["height"], tx["id"]
                     ))
@@ -313,32 +598,184 @@ def parse_block(block, peer=None):
                     fields["de"] = int(fields["de"])
                 if "qt" in fields:
                     fields["qt"] = float(fields["qt"])
-                # add a new reccord in journal
-                contract = dbapi.add_reccord(
-                    block["height"], index, tx["id"], slp_type, **fields
-                )
             except Exception as error:
+                funnel("register")
                 slp.LOG.error(
                     "Error occured with tx %s in block %d",
                     tx["id"], block["height"]
                 )
                 slp.LOG.debug("%r\n%s", error, traceback.format_exc())
             else:
-                # because dbapi.add_reccord could return False or None if
-                # reccord impossible do store in database
-                if contract not in [None, False]:
-                    contracts.append(contract)
+                decoded.append((index, tx["id"], slp_type, fields))
+    return decoded
+
+
+def register_block(block, decoded):
+    """
+    Register decoded contracts as journal reccords. All reccords from the
+    block are inserted in a single batch. Blocks have to be registered in
+    height order because ticker checks and proof of history depend on
+    previous ones.
+
+    Returns:
+        list: contracts inserted in journal.
+    """
+    # reccords to be inserted in journal and contracts to be returned
+    reccords, contracts = [], []
+    for index, txid, slp_type, fields in decoded:
+        try:
+            if fields["tp"] == "GENESIS" and (
+                fields["sy"] in slp.JSON.ask("denied tickers") or
+                dbapi.find_reccord(sy=fields["sy"], legit=True) is not None
+            ):
+                raise Exception("'%s' ticker is denied..." % fields["sy"])
+            # build a new reccord for journal
+            reccord = dbapi.build_reccord(
+                block["height"], index, txid, slp_type, **fields
+            )
+        except Exception as error:
+            funnel("register")
+            slp.LOG.error(
+                "Error occured with tx %s in block %d", txid, block["height"]
+            )
+            slp.LOG.debug("%r\n%s", error, traceback.format_exc())
+        else:
+            # because dbapi.build_reccord returns False if reccord fields
+            # are not valid
+            if reccord is not False:
+                reccords.append(reccord)
+            else:
+                funnel("register")
+    # add all block reccords in journal at once
+    if len(reccords):
+        contracts = dbapi.add_reccords(reccords)
+        funnel("journal", len(contracts))
+        funnel("register", len(reccords) - len(contracts))
     return contracts
 
 
+def parse_block(block, peer=None):
+    """
+    Search valid SLP vendor fields in all transactions from specified block.
+    If any, it is normalized and registered as a rreccord in journal.
+    """
+    return register_block(block, decode_block(block, peer))
+
+
+class Checkpoint:
+    """
+    Synchronization mark kept in memory and persisted atomically at most
+    once per `checkpoint interval` seconds (`0` saves on every call).
+
+    Keys:
+        peer: last good peer.
+        last parsed block: height of the last block queued for parsing.
+        last applied block: height of the last block whose contracts are
+            applied.
+        rebuild: databases have to be rebuilt from journal.
+        missed block: height of the lowest webhook block not queued.
+    """
+
+    def __init__(self, name, folder=None, interval=None):
+        self.name = name
+        self.folder = folder
+        self.interval = slp.JSON.get("checkpoint interval", 10.) \
+            if interval is None else interval
+        self.lock = threading.Lock()
+        self.data = slp.loadJson(name, folder)
+        self.saved = time.time()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def update(self, **kw):
+        with self.lock:
+            self.data.update(**kw)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def resume_height(self):
+        """
+        Height from where to resume synchronization. Blocks queued but not
+        applied before a stop are parsed again.
+        """
+        with self.lock:
+            return self.data.get(
+                "last applied block", self.data.get("last parsed block", 0)
+            )
+
+    def save(self, force=False):
+        """
+        Write mark on disk if `force` or if interval elapsed since last
+        write.
+
+        Returns:
+            bool: `True` if mark was written.
+        """
+        with self.lock:
+            if not force and time.time() - self.saved < self.interval:
+                return False
+            try:
+                slp.dumpJson(dict(self.data), self.name, self.folder)
+            except Exception as error:
+                slp.LOG.error("checkpoint not saved: %r", error)
+                return False
+            self.saved = time.time()
+            return True
+
+
+class Feeder(threading.Thread):
+    """
+    Webhook block buffer. Messenger hands blocks over without waiting and
+    they are pushed into BlockParser queue from here. If the buffer is
+    full too, block is recorded as missed (see `miss_block`).
+    """
+
+    JOB = queue.Queue()
+    STOP = threading.Event()
+    CHECKPOINT = None
+
+    def __init__(self, checkpoint=None, *args, **kwargs):
+        threading.Thread.__init__(self)
+        Feeder.CHECKPOINT = checkpoint
+        self.daemon = True
+        self.start()
+        slp.LOG.info("Feeder %s set", id(self))
+
+    @staticmethod
+    def stop():
+        Feeder.STOP.set()
+        try:
+            Feeder.JOB.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def run(self):
+        Feeder.STOP.clear()
+        while not Feeder.STOP.is_set():
+            block = Feeder.JOB.get()
+            if block is not None and not enqueue(block, Feeder.STOP):
+                miss_block(block)
+        # blocks left in buffer are synchronized on next start
+        while not Feeder.JOB.empty():
+            block = Feeder.JOB.get_nowait()
+            if block is not None:
+                miss_block(block)
+        slp.LOG.info("Feeder %s clean exit", id(self))
+
+
 class BlockParser(threading.Thread):
 
     JOB = queue.Queue()
     LOCK = threading.Lock()
     STOP = threading.Event()
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, checkpoint=None, *args, **kwargs):
         threading.Thread.__init__(self)
+        self.checkpoint = checkpoint
         self.daemon = True
         self.start()
         slp.LOG.info("BlockParser %s set", id(self))
@@ -355,53 +792,141 @@ class BlockParser(threading.Thread):
                 "No modules found to handle '%s' contracts",
                 contract['slp_type']
             )
+        except PyMongoError:
+            # contract left unapplied, caller has to retry
+            raise
         except Exception as error:
             slp.LOG.error(
                 "%r\n%s", error, traceback.format_exc()
             )
 
+    def rebuild(self):
+        # sync imports chain
+        from slp import sync
+        slp.LOG.info("Rebuilding databases from journal")
+        return sync.rebuild(self.checkpoint)
+
+    @staticmethod
+    def apply_block(state, contracts):
+        """
+        Apply contracts on cached state, flushed to database at the end of
+        the block. Returns False if state could not be written, cache being
+        emptied.
+        """
+        try:
+            with state:
+                for contract in contracts:
+                    BlockParser.apply(contract)
+        except Exception as error:
+            slp.LOG.error("Block state not written: %r", error)
+            slp.LOG.debug("traceback data:\n%s", traceback.format_exc())
+            state.clear()
+            return False
+        return True
+
     @staticmethod
     def stop():
         if BlockParser.LOCK.locked():
             BlockParser.LOCK.release()
         BlockParser.STOP.set()
-        BlockParser.JOB.put(None)
+        try:
+            BlockParser.JOB.put_nowait(None)
+        except queue.Full:
+            # BlockParser is busy and will see STOP event on next block
+            pass
 
     def run(self):
         peers = select_peers()
-        peer = random.choice(peers)
+        # spread load over the best peers
+        peer = random.choice(peers[:3])
+        state = dbapi.StateCache()
+        # blocks are downloaded and decoded by a pool of workers while
+        # journal registration and contract application are sequenced in
+        # queue order here
+        workers = slp.JSON.get("parser workers", 4)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        # [block, future] pairs being decoded
+        pending = collections.deque()
         BlockParser.STOP.clear()
         while not BlockParser.STOP.is_set():
-            # atomic action starts here ---
-            block = BlockParser.JOB.get()
-            msg = ""
-            if block is not None:
-                BlockParser.LOCK.acquire()
-                msg += "Parsing % 3d transaction(s) from block %s" % (
-                    block["transactions"], block["height"]
-                )
+            # fill decoding window, wait for a block only if there is nothing
+            # to sequence
+            while len(pending) < 2 * workers:
                 try:
-                    contracts = parse_block(block, peer)
-                except Exception:
-                    msg += " [FAILED]\nPushing back block %d, " \
-                        "not enough transaction found" % block["height"]
-                    slp.LOG.error(msg)
-                    # put the block to the left of queue to be sure it will be
-                    # get first on BlockParser LOCK release
-                    with BlockParser.JOB.mutex:
-                        BlockParser.JOB.queue.appendleft(block)
-                    if peer in peers:
-                        peers.remove(peer)
-                    if len(peers) <= 1:
-                        peers = select_peers()
-                    peer = random.choice(peers)
-                    BlockParser.LOCK.release()
-                else:
-                    msg += " [OK]"
-                    slp.LOG.info(msg)
-                    BlockParser.LOCK.release()
-                    # atomic action is stopped for sure ---
-                    for contract in contracts:
-                        BlockParser.apply(contract)
+                    block = BlockParser.JOB.get(block=len(pending) == 0)
+                except queue.Empty:
+                    break
+                if block is None:
+                    break
+                pending.append(
+                    [block, executor.submit(decode_block, block, peer)]
+                )
+            if not len(pending):
+                continue
+            # atomic action starts here ---
+            block, future = pending[0]
+            BlockParser.LOCK.acquire()
+            msg = "Parsing % 3d transaction(s) from block %s" % (
+                block["transactions"], block["height"]
+            )
+            try:
+                contracts = register_block(block, future.result())
+            except Exception:
+                msg += " [FAILED]\nRetrying block %d, " \
+                    "not enough transaction found" % block["height"]
+                slp.LOG.error(msg)
+                if peer in peers:
+                    peers.remove(peer)
+                if len(peers) <= 1:
+                    peers = select_peers()
+                peer = random.choice(peers[:3])
+                # block stays first so it is sequenced before the others
+                pending[0][1] = executor.submit(decode_block, block, peer)
+                BlockParser.LOCK.release()
             else:
-                slp.LOG.info("BlockParser %s clean exit", id(self))
+                pending.popleft()
+                DRAINED.mark()
+                msg += " [OK]"
+                slp.LOG.info(msg)
+                slp.LOG.debug("vendor field funnel: %s", dict(FUNNEL))
+                BlockParser.LOCK.release()
+                # atomic action is stopped for sure ---
+                # on database failure, contracts left unapplied are reloaded
+                # from journal and applied again. Without transactions, state
+                # may be partially written and is rebuilt from journal
+                applied = BlockParser.apply_block(state, contracts)
+                while not applied and not BlockParser.STOP.wait(
+                    slp.JSON.get("apply retry delay", 5)
+                ):
+                    slp.LOG.info("Retrying block %d", block["height"])
+                    try:
+                        if not dbapi.transactional():
+                            self.rebuild()
+                            applied = True
+                            continue
+                        contracts = list(dbapi.db.journal.find({
+                            "_id": {"$in": [c["_id"] for c in contracts]},
+                            "legit": None
+                        }).sort("_id", 1))
+                    except Exception as error:
+                        slp.LOG.error("%r", error)
+                    else:
+                        applied = BlockParser.apply_block(state, contracts)
+                if not applied:
+                    # contracts will be applied on next start (see
+                    # sync.replay)
+                    break
+                if self.checkpoint is not None:
+                    self.checkpoint.update(
+                        **{"last applied block": block["height"]}
+                    )
+                    # save checkpoint on interval or when queue is drained
+                    self.checkpoint.save(
+                        force=not len(pending) and BlockParser.JOB.empty()
+                    )
+        # blocks left in pending are not applied, they will be parsed again
+        # from checkpoint on next start
+        executor.shutdown(wait=False)
+        if self.checkpoint is not None:
+            self.checkpoint.save(force=True)
+        slp.LOG.info("BlockParser %s clean exit", id(self))
@@ -0,0 +1,241 @@
+# -*- coding:utf-8 -*-
+
+"""
+`client` module is an asyncio HTTP/1.1 client used for outbound calls to
+blockchain and SLP peers. Connections are kept alive in a pool per peer and
+all requests run on a single event loop living in a daemon thread, so a lot
+of requests can be in flight from one process.
+
+Threads use it through blocking helpers:
+
+```python
+>>> from slp import client
+>>> client.get(peer, "api", "blocks", page=1, headers=slp.HEADERS)
+>>> client.run(client.gather(*[
+...     client.request("POST", peer, "message", _jsonify=msg)
+...     for peer in peers
+... ]))
+```
+
+Responses are decoded the way `usrv.req` does: JSON objects get a `status`
+key with HTTP status code, JSON lists are returned as is. A request failing
+at network level returns a dict with an `error` key and no `status`.
+"""
+
+import ssl
+import slp
+import json
+import asyncio
+import threading
+import urllib.parse
+
+#: default request timeout in seconds
+TIMEOUT = 5.
+#: event loop running client coroutines, started on first use
+LOOP = None
+LOCK = threading.Lock()
+#: keep-alive connection pools by peer
+POOLS = {}
+#: in-flight request limit, created within event loop
+LIMIT = None
+
+
+class Pool:
+    """
+    Keep-alive connections to a single peer with a concurrency limit.
+    """
+
+    def __init__(self, peer, size=10):
+        url = urllib.parse.urlsplit(peer)
+        self.host = url.hostname
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip("/")
+        self.ssl = ssl.create_default_context() \
+            if url.scheme == "https" else None
+        self.port = url.port or (443 if self.ssl else 80)
+        self.idle = []
+        self.semaphore = asyncio.Semaphore(size)
+
+    async def request(self, method, target, body=None, headers={}):
+        async with self.semaphore:
+            # an idle connection may have been closed by peer, in this case
+            # retry once on a fresh one
+            for reuse in ([True, False] if len(self.idle) else [False]):
+                if reuse:
+                    reader, writer = self.idle.pop()
+                else:
+                    reader, writer = await asyncio.open_connection(
+                        self.host, self.port, ssl=self.ssl
+                    )
+                try:
+                    status, data, keep = await _exchange(
+                        reader, writer, method, self.netloc,
+                        self.prefix + target, body, headers
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reuse:
+                        continue
+                    raise
+                except BaseException:
+                    # timeout or cancellation, connection state is unknown
+                    writer.close()
+                    raise
+                if keep:
+                    self.idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, data
+
+
+async def _exchange(reader, writer, method, host, target, body, headers):
+    lines = [
+        f"{method} {target} HTTP/1.1", f"Host: {host}",
+        "Connection: keep-alive", "Accept-Encoding: identity"
+    ] + [f"{k}: {v}" for k, v in headers.items()]
+    if body is not None:
+        lines.append(f"Content-Length: {len(body)}")
+    writer.write(
+        ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+    )
+    await writer.drain()
+    # read status line and headers
+    line = await reader.readline()
+    if not line:
+        raise ConnectionResetError("connection closed by peer")
+    version, status = line.split(None, 2)[:2]
+    status = int(status)
+    resp_headers = {}
+    while True:
+        line = await reader.readline()
+        if line in [b"\r\n", b"\n", b""]:
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        resp_headers[key.strip().lower()] = value.strip()
+    keep = version == b"HTTP/1.1" and \
+        resp_headers.get("connection", "").lower() != "close"
+    # read body
+    if method == "HEAD" or status in [204, 304] or status < 200:
+        data = b""
+    elif "chunked" in resp_headers.get("transfer-encoding", ""):
+        data = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # skip trailers
+                while (await reader.readline()) not in [b"\r\n", b"\n", b""]:
+                    pass
+                break
+            data += await reader.readexactly(size)
+            await reader.readexactly(2)
+    elif "content-length" in resp_headers:
+        data = await reader.readexactly(int(resp_headers["content-length"]))
+    else:
+        data = await reader.read()
+        keep = False
+    return status, data, keep
+
+
+def loop():
+    """
+    Return client event loop, starting it in a daemon thread if needed.
+    """
+    global LOOP
+    with LOCK:
+        if LOOP is None:
+            LOOP = asyncio.new_event_loop()
+            threading.Thread(
+                target=LOOP.run_forever, name="client", daemon=True
+            ).start()
+    return LOOP
+
+
+def get_pool(peer):
+    url = urllib.parse.urlsplit(peer)
+    key = f"{url.scheme}://{url.netloc}{url.path.rstrip('/')}"
+    pool = POOLS.get(key, None)
+    if pool is None:
+        pool = POOLS[key] = Pool(key, slp.JSON.get("client pool size", 10))
+    return pool
+
+
+async def request(
+    method, peer, *path, _jsonify=None, headers={}, timeout=None, **params
+):
+    """
+    Send an HTTP request to `peer/path?params` from client event loop.
+
+    Args:
+        method (str): HTTP method.
+        peer (str): peer url as `scheme://host:port`.
+        *path (str): url path elements.
+        _jsonify (any): data to send as JSON body.
+        headers (dict): HTTP headers.
+        timeout (float): request timeout, default to `client.TIMEOUT`.
+        **params (keyword args): url query parameters.
+
+    Returns:
+        dict or list: decoded response.
+    """
+    global LIMIT
+    if LIMIT is None:
+        LIMIT = asyncio.Semaphore(slp.JSON.get("client concurrency", 1000))
+    target = "/" + "/".join(str(p).strip("/") for p in path)
+    if len(params):
+        target += "?" + urllib.parse.urlencode(params, doseq=True)
+    headers = dict(headers)
+    body = None
+    if _jsonify is not None:
+        body = json.dumps(_jsonify).encode("utf-8")
+        headers["Content-Type"] = "application/json"
+    try:
+        async with LIMIT:
+            status, data = await asyncio.wait_for(
+                get_pool(peer).request(method, target, body, headers),
+                timeout or TIMEOUT
+            )
+    except Exception as error:
+        slp.LOG.debug("%s %s%s failed: %r", method, peer, target, error)
+        return {"error": "%r" % error}
+    try:
+        resp = json.loads(data) if len(data) else {}
+    except ValueError:
+        resp = {"raw": data.decode("utf-8", errors="replace")}
+    if isinstance(resp, dict):
+        resp.setdefault("status", status)
+    return resp
+
+
+async def gather(*coroutines, limit=None):
+    """
+    Run coroutines concurrently, at most `limit` at a time if specified.
+    """
+    if limit is None:
+        return await asyncio.gather(*coroutines)
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[bounded(c) for c in coroutines])
+
+
+def run(coroutine, timeout=None):
+    """
+    Run a coroutine on client event loop and wait for its result. It must
+    not be called from the event loop itself.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, loop()).result(timeout)
+
+
+def get(peer, *path, **kw):
+    return run(request("GET", peer, *path, **kw))
+
+
+def post(peer, *path, **kw):
+    return run(request("POST", peer, *path, **kw))
+
+
+def head(peer, *path, **kw):
+    return run(request("HEAD", peer, *path, **kw))
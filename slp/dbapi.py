@@ -6,9 +6,433 @@ import json
 import hashlib
 import decimal
 import traceback
+import threading
+import contextlib
+
+from pymongo import InsertOne, UpdateOne, ReplaceOne, DeleteOne
+from pymongo.errors import (
+    BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+)
 
 # mongo database to be initialized by slp app
 db = None
+#: proof of history tips per collection
+POH = {}
+POH_LOCK = threading.RLock()
+#: thread local storage of the state cache in use, see current_state
+LOCAL = threading.local()
+#: set to False if database does not support multi-document transactions
+TRANSACTIONS = True
+#: unique keys of collections managed by StateCache
+STATE_KEYS = {
+    "contracts": ("tokenId", ),
+    "slp1": ("address", "tokenId"),
+    "slp2": ("address", "tokenId"),
+    "token_stats": ("tokenId", ),
+    "metadata": ("tokenId", )
+}
+#: GENESIS reccord fields kept in token stats
+GENESIS_FIELDS = ("txid", "timestamp", "height", "de", "pa", "mi")
+
+
+class StateCache:
+    """
+    Write-back cache for contracts, slp1 and slp2 documents. Inside a `with`
+    statement, dbapi find/insert/update/delete helpers called from the same
+    thread work on in-memory documents and modifications are sent with bulk
+    writes on exit. Documents stay cached between two `with` statements up
+    to `size` documents.
+
+    An `authoritative` cache holds the whole state: missing documents are
+    not looked up in database and nothing is evicted. It is meant to replay
+    journal on empty collections.
+    """
+
+    MISSING = object()
+
+    def __init__(self, size=None, authoritative=False):
+        self.size = size or slp.JSON.get("state cache size", 10000)
+        self.authoritative = authoritative
+        self.lock = threading.RLock()
+        # (collection, key) -> document or None if it does not exist
+        self.documents = {}
+        self.dirty = set()
+        # keys of documents existing in database
+        self.stored = set()
+        # (collection, tokenId) -> keys of cached documents
+        self.tokens = {}
+        # token id -> GENESIS reccord
+        self.genesis = {}
+        # journal _id -> legit value
+        self.legit = {}
+        self.rejected = []
+        # restore functions of current atomic unit, see begin
+        self.undo = None
+        self.saved = set()
+
+    def __enter__(self):
+        self.lock.acquire()
+        LOCAL.state = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                self.flush()
+            else:
+                self.discard()
+        finally:
+            LOCAL.state = None
+            self.lock.release()
+
+    def begin(self):
+        """
+        Start an atomic unit: modifications made until `commit` can be
+        canceled with `rollback`.
+        """
+        self.undo, self.saved = [], set()
+        n = len(self.rejected)
+        self.undo.append(lambda: self.rejected.__delitem__(slice(n, None)))
+
+    def commit(self):
+        self.undo = None
+        self.saved.clear()
+
+    def rollback(self):
+        for restore in reversed(self.undo or []):
+            restore()
+        self.commit()
+
+    def _save(self, key):
+        if self.undo is None or key in self.saved:
+            return
+        self.saved.add(key)
+        previous = self.documents.get(key, StateCache.MISSING)
+        if isinstance(previous, dict):
+            previous = dict(previous)
+        dirty = key in self.dirty
+
+        def restore():
+            if previous is StateCache.MISSING:
+                self.documents.pop(key, None)
+            else:
+                self.documents[key] = previous
+            if not dirty:
+                self.dirty.discard(key)
+        self.undo.append(restore)
+
+    def discard(self):
+        """
+        Forget all modifications not flushed to database.
+        """
+        with self.lock:
+            for key in self.dirty:
+                self.documents.pop(key, None)
+            self.dirty.clear()
+            self.legit.clear()
+            self.rejected.clear()
+            self.commit()
+
+    def clear(self):
+        """
+        Forget all cached documents. It is meant to be used after a failed
+        flush, database state being unknown.
+        """
+        with self.lock:
+            self.discard()
+            self.documents.clear()
+            self.stored.clear()
+            self.tokens.clear()
+            self.genesis.clear()
+
+    @staticmethod
+    def key(collection, filter):
+        keys = STATE_KEYS[collection]
+        if set(filter) == set(keys):
+            return collection, tuple(filter[k] for k in keys)
+
+    @staticmethod
+    def match(document, filter):
+        return document is not None and all(
+            document.get(k, None) == v for k, v in filter.items()
+        )
+
+    def _track(self, key):
+        collection, values = key
+        tokenId = values[STATE_KEYS[collection].index("tokenId")]
+        self.tokens.setdefault((collection, tokenId), set()).add(key)
+
+    def _get(self, key):
+        if key not in self.documents:
+            if self.authoritative:
+                return None
+            collection, values = key
+            self.documents[key] = getattr(db, collection).find_one(
+                dict(zip(STATE_KEYS[collection], values))
+            )
+            self._track(key)
+            if self.documents[key] is not None:
+                self.stored.add(key)
+        return self.documents[key]
+
+    def find(self, collection, **filter):
+        with self.lock:
+            key = StateCache.key(collection, filter)
+            if key is None:
+                result = self.find_all(collection, **filter)
+                return result[0] if len(result) else None
+            document = self._get(key)
+            return None if document is None else dict(document)
+
+    def find_all(self, collection, **filter):
+        """
+        Database query merged with cached documents.
+        """
+        with self.lock:
+            result, seen = [], set()
+            for document in (
+                [] if self.authoritative else
+                getattr(db, collection).find(filter)
+            ):
+                key = StateCache.key(
+                    collection, dict(
+                        [k, document.get(k, None)]
+                        for k in STATE_KEYS[collection]
+                    )
+                )
+                seen.add(key)
+                document = self.documents.get(key, document)
+                if StateCache.match(document, filter):
+                    result.append(dict(document))
+            # an authoritative cache holds the whole state, flushed
+            # documents included
+            cached = self.documents if self.authoritative else self.dirty
+            if "tokenId" in filter:
+                keys = self.tokens.get((collection, filter["tokenId"]), ())
+            else:
+                keys = list(cached)
+            for key in [k for k in keys if k[0] == collection]:
+                if key in cached and key not in seen:
+                    document = self.documents.get(key, None)
+                    if StateCache.match(document, filter):
+                        result.append(dict(document))
+            return result
+
+    def find_genesis(self, tokenId):
+        with self.lock:
+            if tokenId not in self.genesis:
+                self.genesis[tokenId] = db.journal.find_one(
+                    {"id": tokenId, "tp": "GENESIS"}
+                )
+            return self.genesis[tokenId]
+
+    def insert(self, collection, document):
+        with self.lock:
+            key = StateCache.key(
+                collection, dict(
+                    [k, document[k]] for k in STATE_KEYS[collection]
+                )
+            )
+            if self._get(key) is not None:
+                raise DuplicateKeyError(
+                    f"{collection} duplicate key {key[1]}"
+                )
+            self._save(key)
+            self.documents[key] = dict(document)
+            self._track(key)
+            self.dirty.add(key)
+            return True
+
+    def update(self, collection, filter, values):
+        with self.lock:
+            key = StateCache.key(collection, filter)
+            document = self._get(key)
+            # as update_one does, nothing to do if document does not exist
+            if document is not None:
+                self._save(key)
+                document.update(values)
+                self.dirty.add(key)
+            return True
+
+    def delete(self, collection, filter):
+        with self.lock:
+            key = StateCache.key(collection, filter)
+            if self._get(key) is not None:
+                self._save(key)
+                self.documents[key] = None
+                self.dirty.add(key)
+            return True
+
+    def set_legit(self, _id, value):
+        with self.lock:
+            if self.undo is not None:
+                previous = self.legit.get(_id, StateCache.MISSING)
+                self.undo.append(
+                    lambda: self.legit.pop(_id, None)
+                    if previous is StateCache.MISSING else
+                    self.legit.__setitem__(_id, previous)
+                )
+            self.legit[_id] = value
+            return value
+
+    def reject(self, contract):
+        with self.lock:
+            self.rejected.append(dict(contract))
+            return True
+
+    def operations(self):
+        """
+        Build bulk write operations per collection from dirty documents.
+        """
+        operations = {}
+        for key in self.dirty:
+            collection, values = key
+            document = self.documents[key]
+            filter = dict(zip(STATE_KEYS[collection], values))
+            if key in self.stored:
+                request = DeleteOne(filter) if document is None else \
+                    ReplaceOne(filter, document)
+            elif document is not None:
+                request = InsertOne(document)
+            else:
+                continue
+            operations.setdefault(collection, []).append(request)
+        # upsert so a contract rejected twice does not break the transaction
+        if len(self.rejected):
+            operations["rejected"] = [
+                ReplaceOne(
+                    {"height": contract["height"], "index": contract["index"]},
+                    dict([k, v] for k, v in contract.items() if k != "_id"),
+                    upsert=True
+                ) for contract in self.rejected
+            ]
+        # legit flags come last: without transaction, they are written only
+        # if all state modifications were
+        if len(self.legit):
+            operations["journal"] = [
+                UpdateOne({"_id": _id}, {"$set": {"legit": value}})
+                for _id, value in self.legit.items()
+            ]
+        return operations
+
+    @staticmethod
+    def write(operations, session=None):
+        for collection, requests in operations.items():
+            getattr(db, collection).bulk_write(
+                requests, ordered=False, session=session
+            )
+
+    def flush(self):
+        """
+        Send all modifications to database in a single transaction, legit
+        flags being committed together with state modifications. Falls back
+        to plain bulk writes if database does not support transactions.
+        """
+        global TRANSACTIONS
+        with self.lock:
+            operations = self.operations()
+            if len(operations) == 0:
+                pass
+            elif transactional():
+                try:
+                    with db.client.start_session() as session:
+                        session.with_transaction(
+                            lambda s: StateCache.write(operations, s)
+                        )
+                except OperationFailure as error:
+                    # IllegalOperation: standalone mongod
+                    if error.code != 20:
+                        raise
+                    slp.LOG.warning(
+                        "Transactions not supported by database, "
+                        "state is written without transaction"
+                    )
+                    TRANSACTIONS = False
+                    StateCache.write(operations)
+            else:
+                StateCache.write(operations)
+            for key in self.dirty:
+                if self.documents[key] is None:
+                    self.stored.discard(key)
+                else:
+                    self.stored.add(key)
+            self.dirty.clear()
+            self.legit.clear()
+            self.rejected.clear()
+            # documents are all clean here
+            if not self.authoritative:
+                if len(self.documents) > self.size:
+                    self.documents.clear()
+                    self.stored.clear()
+                    self.tokens.clear()
+                if len(self.genesis) > self.size:
+                    self.genesis.clear()
+
+
+def current_state():
+    """
+    Return the state cache used by current thread, `None` if any.
+    """
+    return getattr(LOCAL, "state", None)
+
+
+def transactional():
+    """
+    Return `True` if state is written with multi-document transactions. If
+    not, a failed or interrupted flush may leave state partially written
+    and state has to be rebuilt from journal.
+    """
+    return TRANSACTIONS and slp.JSON.get("mongo transactions", True)
+
+
+def check_transactions():
+    """
+    Set `TRANSACTIONS` according to database deployment: transactions need
+    a replica set or a sharded cluster.
+    """
+    global TRANSACTIONS
+    try:
+        hello = db.client.admin.command("hello")
+    except Exception as error:
+        slp.LOG.error("database deployment not checked: %r", error)
+    else:
+        TRANSACTIONS = "setName" in hello or hello.get("msg") == "isdbgrid"
+    return transactional()
+
+
+def drop_state():
+    """
+    Empty contracts, wallets and collections derived from contract
+    application, indexes are kept.
+    """
+    for name in [
+        "contracts", "rejected", "slp1", "slp2", "token_stats", "metadata"
+    ]:
+        getattr(db, name).delete_many({})
+
+
+@contextlib.contextmanager
+def atomic():
+    """
+    Contract application unit. All state modifications made inside, and the
+    legit flag, are committed together or not at all. It uses current state
+    cache if any, else a state cache flushed in a single transaction.
+    """
+    state = current_state()
+    if state is None:
+        with StateCache():
+            yield
+    elif state.undo is not None:
+        yield
+    else:
+        state.begin()
+        try:
+            yield
+        except Exception:
+            state.rollback()
+            raise
+        else:
+            state.commit()
 
 
 def set_legit(filter, value=True):
@@ -16,10 +440,41 @@ def set_legit(filter, value=True):
     Update legit value of a journal reccord.
     """
     value = bool(value)
+    # filter is the whole reccord when contract is applied
+    if value and "id" in filter:
+        count_token_tx(filter)
+    state = current_state()
+    if state is not None:
+        return state.set_legit(filter["_id"], value)
     db.journal.update_one(filter, {'$set': {"legit": value}})
     return value
 
 
+def reject(contract):
+    """
+    Store a contract in rejected collection.
+    """
+    state = current_state()
+    if state is not None:
+        return state.reject(contract)
+    return db.rejected.insert_one(contract)
+
+
+def abort(contract, error):
+    """
+    Terminate a contract whose application raised: it is flagged as not
+    legit and rejected, outside of the rolled back unit, so it is never
+    replayed later on a different state. Database failures are raised
+    again, contract being left unapplied to be retried.
+    """
+    if isinstance(error, PyMongoError) and \
+       not isinstance(error, DuplicateKeyError):
+        raise error
+    contract["comment"] = "%r" % error
+    reject(contract)
+    return set_legit({"_id": contract["_id"]}, False)
+
+
 def blockstamp_cmp(a, b):
     """
     Blockstamp comparison. Returns True if a higher than b.
@@ -34,15 +489,36 @@ def blockstamp_cmp(a, b):
         return False
 
 
-def compute_poh(name, last_poh=None, **data):
-    col = getattr(db, name)
-    # if no previous poh given, get last from collection
-    if last_poh is None:
+def load_poh(name):
+    """
+    Load proof of history tip from collection. Tip is the poh of the last
+    inserted document, whatever its legit value, so it chains every journal
+    reccord in insertion order.
+    """
+    with POH_LOCK:
         try:
-            filters = {"legit": True} if col == "journal" else {}
-            last_poh = col.find(filters).sort("_id", -1)[0].get("poh", "")
+            POH[name] = list(
+                getattr(db, name).find({}).sort("_id", -1).limit(1)
+            )[0].get("poh", "")
         except Exception:
-            last_poh = ""
+            POH[name] = ""
+        return POH[name]
+
+
+def poh_tip(name):
+    """
+    Return cached proof of history tip of collection.
+    """
+    with POH_LOCK:
+        if name not in POH:
+            return load_poh(name)
+        return POH[name]
+
+
+def compute_poh(name, last_poh=None, **data):
+    # if no previous poh given, get tip from cache
+    if last_poh is None:
+        last_poh = poh_tip(name)
     # data could be slp fields or consent message containing slp fields hash
     if "hash" not in data:
         seed = json.dumps(data, sort_keys=True, separators=(',', ':'))
@@ -53,14 +529,14 @@ def compute_poh(name, last_poh=None, **data):
     return hashlib.sha256(seed.encode("utf-8")).hexdigest()
 
 
-def add_reccord(
+def build_reccord(
     height, index, txid, slp_type, timestamp, emitter, receiver, cost, **kw
 ):
     """
-    Add a reccord in the journal.
+    Build a validated journal reccord. Proof of history is computed on
+    insertion.
 
     Args:
-        poh (str): proof of history as hex string.
         height (int): block height.
         index (int): transaction index in the block.
         txid (str): transaction id as hex.
@@ -72,7 +548,7 @@ def add_reccord(
         **kw (keyword args): contract field values.
 
     Returns:
-        bool: `True` if success else `False`.
+        dict: journal reccord if fields are valid else `False`.
     """
     fields = dict(
         [k, v] for k, v in kw.items()
@@ -84,46 +560,396 @@ def add_reccord(
         if slp_type.endswith("1"):
             fields.update(mi=kw.get("mi", False))
 
-    if not slp.validate(**fields):
-        slp.LOG.error("field validation did not pass")
-        slp.dumpJson(
-            dict(
-                slp.loadJson(f"unvalidated.{slp_type}", ".json"),
-                **{f"{height}#{index}": fields}
-            ), f"unvalidated.{slp_type}", os.path.join(slp.ROOT, ".json")
+    reason = slp.check(fields, height)
+    if reason is not None:
+        slp.LOG.error("field validation did not pass: %s", reason)
+        add_unvalidated(
+            height, index, txid, slp_type, timestamp, emitter, receiver,
+            cost, reason, **fields
         )
         return False
 
+    return dict(
+        poh=None, height=height, index=index, txid=txid, slp_type=slp_type,
+        emitter=emitter, receiver=receiver, timestamp=timestamp,
+        cost=cost, legit=None, **fields
+    )
+
+
+def add_unvalidated(
+    height, index, txid, slp_type, timestamp, emitter, receiver, cost,
+    reason, **fields
+):
+    """
+    Store a contract that did not pass field validation. Unvalidated
+    collection is append-only: a contract already stored at the same
+    blockstamp is left untouched.
+
+    Args:
+        reason (dict): validation failure reason.
+        **fields (keyword args): contract field values.
+
+    Returns:
+        bool: `True` if contract was not already stored.
+    """
     try:
-        contract = dict(
-            poh=compute_poh("journal", **fields),
-            height=height, index=index, txid=txid, slp_type=slp_type,
-            emitter=emitter, receiver=receiver, timestamp=timestamp,
-            cost=cost, legit=None, **fields
+        result = db.unvalidated.update_one(
+            {"height": height, "index": index},
+            {"$setOnInsert": dict(
+                blockStamp=f"{height}#{index}", txid=txid, slp_type=slp_type,
+                emitter=emitter, receiver=receiver, timestamp=timestamp,
+                cost=cost, reason=reason, **fields
+            )}, upsert=True
         )
-        db.journal.insert_one(contract)
     except Exception as error:
-        slp.LOG.error("%r", error)
-        slp.LOG.debug("traceback data:\n%s", traceback.format_exc())
+        slp.LOG.error("unvalidated contract not stored: %r", error)
+        slp.LOG.debug("%s", traceback.format_exc())
         return False
-    else:
-        return contract
+    return result.upserted_id is not None
+
+
+def import_unvalidated(folder):
+    """
+    Move contracts stored in `unvalidated.<slp_type>` json files by previous
+    versions to unvalidated collection. Files only kept contract fields by
+    blockstamp, so transaction values are left to `None` and failure reason
+    is computed again. Imported files are renamed with `.imported` suffix.
+
+    Returns:
+        int: number of contracts imported.
+    """
+    imported = 0
+    for name in [
+        n for n in sorted(os.listdir(folder)) if os.path.isfile(
+            os.path.join(folder, n)
+        ) and n.startswith("unvalidated.") and n.count(".") == 1
+    ]:
+        slp_type = name.split(".")[-1]
+        for blockstamp, fields in slp.loadJson(name, folder).items():
+            height, index = [int(e) for e in blockstamp.split("#")]
+            try:
+                reason = slp.check(fields, height)
+            except Exception as error:
+                reason = {"error": "%r" % error}
+            imported += add_unvalidated(
+                height, index, None, slp_type, None, None, None, None,
+                reason or {}, **fields
+            )
+        os.replace(
+            os.path.join(folder, name),
+            os.path.join(folder, f"{name}.imported")
+        )
+        slp.LOG.info("%s moved to unvalidated collection", name)
+    return imported
+
+
+def reccord_fields(reccord):
+    """
+    Extract slp fields used for proof of history computation.
+    """
+    slp_fields = slp.JSON.ask("slp fields", reccord["height"])
+    return dict([k, v] for k, v in reccord.items() if k in slp_fields)
+
+
+def add_reccord(
+    height, index, txid, slp_type, timestamp, emitter, receiver, cost, **kw
+):
+    """
+    Add a reccord in the journal.
+
+    Args:
+        height (int): block height.
+        index (int): transaction index in the block.
+        txid (str): transaction id as hex.
+        slp_type (str): see SLP contract types.
+        timestamp (float): unix timestamp.
+        emitter (str): sender id wallet.
+        receiver (str): recipient id wallet.
+        cost (int): amount of transaction.
+        **kw (keyword args): contract field values.
+
+    Returns:
+        bool: `True` if success else `False`.
+    """
+    contract = build_reccord(
+        height, index, txid, slp_type, timestamp, emitter, receiver, cost,
+        **kw
+    )
+    if contract is False:
+        return False
+
+    # computing poh and inserting reccord have to be atomic
+    with POH_LOCK:
+        try:
+            contract["poh"] = compute_poh(
+                "journal", **reccord_fields(contract)
+            )
+            db.journal.insert_one(contract)
+        except Exception as error:
+            slp.LOG.error("%r", error)
+            slp.LOG.debug("traceback data:\n%s", traceback.format_exc())
+            return False
+        else:
+            POH["journal"] = contract["poh"]
+            return contract
+
+
+def add_reccords(reccords):
+    """
+    Add a batch of reccords in the journal with a single ordered insertion.
+    Proof of history is chained in memory across the batch. As `add_reccord`
+    does, a reccord that can not be inserted (ie (height, index) duplicate)
+    is skipped and next reccords are chained on last inserted one.
+
+    Args:
+        reccords (list): reccords built with `build_reccord`.
+
+    Returns:
+        list: inserted reccords.
+    """
+    with POH_LOCK:
+        inserted = _add_reccords(reccords)
+        if len(inserted):
+            POH["journal"] = inserted[-1]["poh"]
+    return inserted
+
+
+def _add_reccords(reccords):
+    pending, inserted = list(reccords), []
+    last_poh = None
+    while len(pending):
+        # chain poh on the batch, first one is chained on the journal
+        poh = last_poh
+        for reccord in pending:
+            reccord["poh"] = poh = compute_poh(
+                "journal", poh, **reccord_fields(reccord)
+            )
+        try:
+            db.journal.insert_many(pending, ordered=True)
+        except BulkWriteError as error:
+            n = error.details.get("nInserted", 0)
+            inserted += pending[:n]
+            slp.LOG.error(
+                "%r", error.details.get("writeErrors", [{}])[0].get("errmsg")
+            )
+            if n > 0:
+                last_poh = pending[n-1]["poh"]
+            # skip the reccord that could not be inserted
+            for reccord in pending[n+1:]:
+                reccord.pop("_id", None)
+            pending = pending[n+1:]
+        except Exception as error:
+            slp.LOG.error("%r", error)
+            slp.LOG.debug("traceback data:\n%s", traceback.format_exc())
+            break
+        else:
+            inserted += pending
+            pending = []
+    return inserted
 
 
 def find_reccord(**filter):
+    state = current_state()
+    if state is not None and filter.get("tp", None) == "GENESIS" and \
+       set(filter) == set(["id", "tp"]):
+        return state.find_genesis(filter["id"])
     return db.journal.find_one(filter)
 
 
+def find_document(collection, **filter):
+    state = current_state()
+    if state is not None:
+        return state.find(collection, **filter)
+    return getattr(db, collection).find_one(filter)
+
+
+def find_documents(collection, **filter):
+    state = current_state()
+    if state is not None:
+        return state.find_all(collection, **filter)
+    return list(getattr(db, collection).find(filter))
+
+
 def find_contract(**filter):
-    return db.contracts.find_one(filter)
+    return find_document("contracts", **filter)
 
 
 def find_slp1_wallet(**filter):
-    return db.slp1.find_one(filter)
+    return find_document("slp1", **filter)
 
 
 def find_slp2_wallet(**filter):
-    return db.slp2.find_one(filter)
+    return find_document("slp2", **filter)
+
+
+def find_slp2_wallets(**filter):
+    return find_documents("slp2", **filter)
+
+
+def insert_document(collection, document):
+    state = current_state()
+    if state is not None:
+        return state.insert(collection, document)
+    return getattr(db, collection).insert_one(document)
+
+
+def insert_contract(document):
+    return insert_document("contracts", document)
+
+
+def insert_slp1_wallet(document):
+    result = insert_document("slp1", document)
+    update_token_stats(document["tokenId"], holders=1)
+    return result
+
+
+def insert_slp2_wallet(document):
+    result = insert_document("slp2", document)
+    update_token_stats(document["tokenId"], holders=1)
+    if len(document.get("metadata", b"")):
+        index_metadata(document["tokenId"])
+    return result
+
+
+def delete_slp2_wallet(address, tokenId):
+    query = {"tokenId": tokenId, "address": address}
+    state = current_state()
+    if state is not None:
+        wallet = state.find("slp2", **query)
+        result = state.delete("slp2", query)
+    else:
+        wallet = db.slp2.find_one_and_delete(query)
+        result = wallet is not None
+    if wallet is not None:
+        update_token_stats(tokenId, holders=-1)
+        if len(wallet.get("metadata", b"")):
+            index_metadata(tokenId)
+    return result
+
+
+def update_token_stats(tokenId, values={}, **increments):
+    """
+    Increment token stats counters and set values, stats document being
+    created if needed. Within a state cache, stats are committed with the
+    contract that modified them.
+
+    Args:
+        tokenId (str): token id.
+        values (dict): values to set.
+        **increments (keyword args): counter increments.
+    """
+    state = current_state()
+    if state is None:
+        return db.token_stats.update_one(
+            {"tokenId": tokenId},
+            {"$inc": increments, "$set": values}, upsert=True
+        )
+    stats = state.find("token_stats", tokenId=tokenId)
+    if stats is None:
+        stats = dict(
+            tokenId=tokenId, txCount=0, holders=0, spent=0,
+            lastUpdatedBlock=None
+        )
+        state.insert("token_stats", stats)
+    values = dict(values, **dict(
+        [k, stats.get(k, 0) + v] for k, v in increments.items()
+    ))
+    return state.update("token_stats", {"tokenId": tokenId}, values)
+
+
+def count_token_tx(reccord):
+    """
+    Account a legit journal reccord in token stats.
+    """
+    values = {"lastUpdatedBlock": reccord["height"]}
+    if reccord.get("tp", None) == "GENESIS":
+        values["genesis"] = dict(
+            [k, reccord[k]] for k in GENESIS_FIELDS if k in reccord
+        )
+    return update_token_stats(
+        reccord["id"], values, txCount=1, spent=reccord.get("cost", 0)
+    )
+
+
+def index_metadata(tokenId):
+    """
+    Update merged metadata of an SLP2 token from its wallets. Wallet
+    metadata are concatenated by blockstamp so keys of the last modified
+    wallet win when decoded.
+    """
+    wallets = sorted(
+        find_slp2_wallets(tokenId=tokenId),
+        key=lambda w: [int(e) for e in w["blockStamp"].split("#")]
+    )
+    document = dict(
+        tokenId=tokenId,
+        blockStamp=wallets[-1]["blockStamp"] if len(wallets) else "0#0",
+        metadata=b"".join(bytes(w.get("metadata", b"")) for w in wallets)
+    )
+    state = current_state()
+    if state is None:
+        return db.metadata.replace_one(
+            {"tokenId": tokenId}, document, upsert=True
+        )
+    if state.find("metadata", tokenId=tokenId) is None:
+        return state.insert("metadata", document)
+    return state.update("metadata", {"tokenId": tokenId}, document)
+
+
+def build_metadata_index():
+    """
+    Rebuild metadata collection from slp2 wallets.
+
+    Returns:
+        int: number of indexed tokens.
+    """
+    tokenIds = db.slp2.distinct("tokenId", {"metadata": {"$ne": b""}})
+    for tokenId in tokenIds:
+        index_metadata(tokenId)
+    db.metadata.delete_many({"tokenId": {"$nin": tokenIds}})
+    return len(tokenIds)
+
+
+def build_token_stats():
+    """
+    Rebuild token stats collection from legit journal reccords and wallets.
+    It is meant to backfill stats on a database populated before token
+    stats were maintained.
+
+    Returns:
+        int: number of token stats documents written.
+    """
+    stats = {}
+    for doc in db.journal.aggregate([
+        {'$match': {'legit': True}},
+        {'$sort': {'height': 1, 'index': 1}},
+        {'$group': {
+            '_id': '$id',
+            'txCount': {'$sum': 1},
+            'spent': {'$sum': '$cost'},
+            'lastUpdatedBlock': {'$last': '$height'},
+            'genesis': {'$first': dict(
+                [k, f"${k}"] for k in GENESIS_FIELDS
+            )}
+        }}
+    ], allowDiskUse=True):
+        tokenId = doc.pop("_id")
+        stats[tokenId] = dict(doc, tokenId=tokenId, holders=0)
+    for col in slp.JSON.ask("slp types"):
+        for doc in getattr(db, col[1:]).aggregate([
+            {'$group': {'_id': '$tokenId', 'holders': {'$sum': 1}}}
+        ]):
+            stats.setdefault(doc["_id"], dict(
+                tokenId=doc["_id"], txCount=0, spent=0,
+                lastUpdatedBlock=None, holders=0
+            ))["holders"] += doc["holders"]
+    if len(stats):
+        db.token_stats.bulk_write([
+            ReplaceOne({"tokenId": tokenId}, document, upsert=True)
+            for tokenId, document in stats.items()
+        ], ordered=False)
+    db.token_stats.delete_many({"tokenId": {"$nin": list(stats)}})
+    return len(stats)
 
 
 def update_contract(tokenId, values):
@@ -134,7 +960,11 @@ def update_contract(tokenId, values):
             if k in "tokenId,height,index,type,name,owner,"
                     "globalSupply,paused,minted,burned,crossed"
         )}
-        db.contracts.update_one(query, update)
+        state = current_state()
+        if state is not None:
+            state.update("contracts", query, update["$set"])
+        else:
+            db.contracts.update_one(query, update)
     except Exception as error:
         slp.LOG.error("%r", error)
         slp.LOG.debug("traceback data:\n%s", traceback.format_exc())
@@ -149,7 +979,13 @@ def update_slp_wallet(collection, address, tokenId, values):
             [k, v] for k, v in values.items()
             if k in "address,tokenId,blockStamp,balance,owner,frozen,metadata"
         )}
-        getattr(db, collection).update_one(query, update)
+        state = current_state()
+        if state is not None:
+            state.update(collection, query, update["$set"])
+        else:
+            getattr(db, collection).update_one(query, update)
+        if collection == "slp2" and "metadata" in update["$set"]:
+            index_metadata(tokenId)
     except Exception as error:
         slp.LOG.error("%r", error)
         slp.LOG.debug("traceback data:\n%s", traceback.format_exc())
@@ -177,7 +1013,7 @@ def exchange_slp1_token(tokenId, sender, receiver, qt):
         _receiver = find_slp1_wallet(address=receiver, tokenId=tokenId)
         # create it with needed
         if _receiver is None:
-            db.slp1.insert_one(
+            insert_slp1_wallet(
                 dict(
                     address=receiver, tokenId=tokenId, blockStamp="0#0",
                     balance=_decimal128(0.), owner=False, frozen=False
@@ -186,28 +1022,17 @@ def exchange_slp1_token(tokenId, sender, receiver, qt):
             new_balance = qt
         else:
             new_balance = _receiver["balance"].to_decimal() + qt
-        # first update receiver
+        # contract application is atomic (see atomic), no need to get back
+        # received token if emitter update fails
         if update_slp1_wallet(
             receiver, tokenId, {"balance": _decimal128(new_balance)}
+        ) and update_slp1_wallet(
+            sender, tokenId, {
+                "balance": _decimal128(_sender["balance"].to_decimal() - qt)
+            }
         ):
-            # if reception is a success, update emitter
-            if update_slp1_wallet(
-                sender, tokenId, {
-                    "balance":
-                        _decimal128(_sender["balance"].to_decimal() - qt)
-                }
-            ):
-                # and return True if success
-                return True
-            else:
-                # if error with sender update get back received token
-                update_slp1_wallet(
-                    receiver, tokenId, {
-                        "balance":
-                            _decimal128(_receiver["balance"].to_decimal() - qt)
-                    }
-                )
-                return False
+            return True
+        raise Exception(f"{tokenId} token exchange failed")
 
     slp.LOG.error(
         "%s wallet does not exists with contract %s", sender, tokenId
@@ -222,30 +1047,21 @@ def get_unix_time(blockstamp, peer=None):
         return reccord.get("timestamp", None)
 
 
-def token_details(tokenId):
+def token_details(*tokenIds):
     """
-    Compute token details using mongo db aggregations.
+    Compute token details from contracts and token stats documents, using a
+    single indexed lookup per token.
     """
-    match = {'$match': {'tokenId': {'$eq': tokenId}}}
-    reccord_lookup = {
+    match = {'$match': {'tokenId': {'$in': list(tokenIds)}}}
+    stats_lookup = {
         '$lookup': {
-            'from': 'journal',
-            'pipeline': [{'$match': {'id': tokenId, 'legit': True}}],
-            'as': 'reccords'
+            'from': 'token_stats',
+            'localField': 'tokenId', 'foreignField': 'tokenId',
+            'as': 'stats'
         }
     }
-    slp_lookup = [
-        {
-            '$lookup': {
-                'from': col[1:],
-                'localField': 'tokenId', 'foreignField': 'tokenId',
-                'as': col
-            }
-        } for col in slp.JSON.ask("slp types")
-    ]
     add_fields = {
         '$addFields': {
-            '_table': {'$substr': ['$type', 1, -1]},
             '_type': {
                 '$substr': [
                     '$type', {'$subtract': [{'$strLenCP': '$type'}, 1]}, 1
@@ -254,7 +1070,7 @@ def token_details(tokenId):
             '_minted': {'$getField': 'minted'},
             '_burned': {'$getField': 'burned'},
             '_crossed': {'$getField': 'crossed'},
-            '_0': {'$first': '$reccords'}
+            '_s': {'$ifNull': [{'$first': '$stats'}, {}]}
         }
     }
     project = {
@@ -266,37 +1082,26 @@ def token_details(tokenId):
                 'ownerAddress': '$owner',
                 'tokenIdHex': '$tokenId',
                 'versionType': '$_type',
-                'genesis_transaction_id': {
-                    '$getField': {'field': 'txid', 'input': '$_0'}
-                },
-                'genesis_timestamp_unix': {
-                    '$getField': {'field': 'timestamp', 'input': '$_0'}
-                },
+                'genesis_transaction_id': '$_s.genesis.txid',
+                'genesis_timestamp_unix': '$_s.genesis.timestamp',
                 'symbol': '$symbol',
                 'tokenName': '$name',
                 'documentUri': '$document',
                 'genesisQuantity': {
                     '$toString': {'$getField': 'globalSupply'}
                 },
-                'decimals': {'$getField': {'field': 'de', 'input': '$_0'}},
-                'pausable': {'$getField': {'field': 'pa', 'input': '$_0'}},
-                'mintable': {'$getField': {'field': 'mi', 'input': '$_0'}}
+                'decimals': '$_s.genesis.de',
+                'pausable': '$_s.genesis.pa',
+                'mintable': '$_s.genesis.mi'
             },
             'tokenStats': {
-                'block_created_height': {
-                    '$getField': {'field': 'height', 'input': '$_0'}
-                },
+                'block_created_height': '$_s.genesis.height',
                 'creation_transaction_id': '$txid',
-                'qty_valid_txns_since_genesis': {'$size': '$reccords'},
+                'qty_valid_txns_since_genesis': {
+                    '$ifNull': ['$_s.txCount', 0]
+                },
                 'qty_valid_token_addresses': {
-                    '$reduce': {
-                        'input': [
-                            {'$size': '$%s' % t}
-                            for t in slp.JSON.ask("slp types")
-                        ],
-                        'initialValue': 0,
-                        'in': {'$add': ["$$value", "$$this"]}
-                    }
+                    '$ifNull': ['$_s.holders', 0]
                 },
                 'qty_token_minted': {'$toString': '$_minted'},
                 'qty_token_burned': {'$toString': '$_burned'},
@@ -312,44 +1117,49 @@ def token_details(tokenId):
                     ]
                 },
                 'qty_total_spent': {
-                    '$divide': [{'$sum': '$reccords.cost'}, 100000000]
+                    '$divide': [{'$ifNull': ['$_s.spent', 0]}, 100000000]
                 },
             },
-            'lastUpdatedBlock': {
-                '$getField': {
-                    'field': 'height', 'input': {
-                        '$last': '$reccords'
-                    }
-                }
-            }
+            'lastUpdatedBlock': '$_s.lastUpdatedBlock'
         }
     }
     return db.contracts.aggregate(
-        [match, reccord_lookup] + slp_lookup + [add_fields, project]
+        [match, stats_lookup, add_fields, project]
     )
 
 
-def wallets(address=None, tokenId=None):
-    ppln = [{'$match': {"address": address}}] if address is not None else []
-    ppln += [{'$match': {"tokenId": tokenId}}] if tokenId is not None else []
-    return db.contracts.aggregate(
-        [
-            {'$limit': 1},
-            {'$project': {'_id': '$$REMOVE'}},
-        ] + [
-            {'$lookup': {'from': col[1:], 'pipeline': ppln, 'as': col}}
-            for col in slp.JSON.ask("slp types")
-        ] + [
-            {
-                '$project': {
-                    'union': {
-                        '$concatArrays':
-                        ['$%s' % n for n in slp.JSON.ask("slp types")]
-                    }
-                }
-            },
-            {'$unwind': '$union'},
-            {'$replaceRoot': {'newRoot': '$union'}},
+def paginate(pipeline, shape, skip=0, limit=None, count=False):
+    """
+    Insert pagination stages between matching and shaping stages of an
+    aggregation so only the asked page is shaped and sent. If `count`, page
+    and total count are computed in a single `$facet` stage returning one
+    `{"data": [...], "total": [{"count": ...}]}` document.
+    """
+    page = [{'$skip': skip}] if skip else []
+    page += [{'$limit': limit}] if limit else []
+    if count:
+        return pipeline + [
+            {'$facet': {'data': page + shape, 'total': [{'$count': 'count'}]}}
+        ]
+    return pipeline + page + shape
+
+
+def wallets(address=None, tokenId=None, skip=0, limit=None, count=False):
+    """
+    Wallets of all slp types matching address and/or token id. Each slp
+    collection is queried on its own index and results are chained with
+    `$unionWith`.
+    """
+    match = dict(
+        [k, v] for k, v in [("address", address), ("tokenId", tokenId)]
+        if v is not None
+    )
+    cols = [slp_type[1:] for slp_type in slp.JSON.ask("slp types")]
+    return db[cols[0]].aggregate(paginate(
+        [{'$match': match}] + [
+            {'$unionWith': {'coll': col, 'pipeline': [{'$match': match}]}}
+            for col in cols[1:]
+        ], [
             {'$lookup': {
                 'from': 'contracts',
                 'localField': 'tokenId', 'foreignField': 'tokenId',
@@ -374,23 +1184,24 @@ def wallets(address=None, tokenId=None):
                 },
                 'owner': 1, 'frozen': 1, 'blockStamp': 1,
             }}
-        ]
-    )
+        ], skip, limit, count
+    ))
 
 
-def transactions(txid=None, tokenId=None, address=None):
-    ppln = [{'$match': {"txid": txid}}] if txid is not None else []
-    ppln += [{'$match': {"tokenId": tokenId}}] if tokenId is not None else []
-    ppln += [{'$match': {"emitter": address}}] if address is not None else []
-    return db.contracts.aggregate(
-        [
-            {'$limit': 1},
-            {'$project': {'_id': '$$REMOVE'}}
-        ] + [
-            {'$lookup': {'from': 'journal', 'pipeline': ppln, 'as': 'txs'}}
-        ] + [
-            {'$unwind': '$txs'},
-            {'$replaceRoot': {'newRoot': '$txs'}},
+def transactions(
+    txid=None, tokenId=None, address=None, skip=0, limit=None, count=False
+):
+    """
+    Journal entries matching transaction id, token id and/or emitter, in
+    blockstamp order.
+    """
+    match = dict(
+        [k, v] for k, v in [
+            ("txid", txid), ("id", tokenId), ("emitter", address)
+        ] if v is not None
+    )
+    return db.journal.aggregate(paginate(
+        [{'$match': match}, {'$sort': {'height': 1, 'index': 1}}], [
             {'$project': {
                 '_id': 0, 'txid': 1,
                 'blockHeight': '$height',
@@ -416,5 +1227,5 @@ def transactions(txid=None, tokenId=None, address=None):
                     'cost': {'$divide': ['$cost', 100000000]}
                 }
             }}
-        ]
-    )
+        ], skip, limit, count
+    ))
@@ -38,6 +38,16 @@ def send_peers(**request):
         return list(node.PEERS)
 
 
+# listen requests to /gauges endpoint
+@srv.bind("/gauges", methods=["GET"], app=srv.uJsonHandler)
+def send_gauges(**request):
+    if request["method"] == "GET":
+        return {
+            "status": 200, "blocks": chain.gauges(),
+            "consensus": node.Consensus.stats()
+        }
+
+
 class Memory(queue.Queue):
     """
     Queue avoiding double inputs.
@@ -86,6 +96,18 @@ class Messenger(threading.Thread):
 
     @staticmethod
     def put(request):
+        data = request.get("data", {})
+        if not isinstance(data, dict):
+            try:
+                data = json.loads(data)
+            except Exception:
+                pass
+        # batched messages from node.Broadcaster are queued one by one
+        if isinstance(data, dict) and "batch" in data:
+            return [
+                Messenger.put(dict(request, data=msg))
+                for msg in data["batch"]
+            ]
         # try to memorize message
         queued = Messenger.MEM.put(request.get("data", {}))
         # memorized
@@ -127,7 +149,9 @@ class Messenger(threading.Thread):
                             resp = node.manage_consensus(msg)
                         if "consent" in msg:
                             n = msg["consent"].pop("#", None)
-                            resp = node.Consensus.update(**msg["consent"])
+                            resp = node.Consensus.update(
+                                nonce=n, **msg["consent"]
+                            )
                             slp.LOG.info("%r #%s: %s", msg, n, resp)
                 else:
                     slp.LOG.info("Messenger %s clean exit", id(self))
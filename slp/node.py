@@ -3,14 +3,16 @@
 import os
 import slp
 import math
+import time
 import json
 import queue
+import asyncio
 import hashlib
 import threading
 import traceback
+import collections
 
-from usrv import req
-from slp import dbapi
+from slp import dbapi, client
 
 #: place to sort discovered peers
 PEERS = set([])
@@ -22,7 +24,7 @@ def send_message(msg, *peers):
     """
     Post message to `/message` endpoints from a peer selection.
     """
-    return Broadcaster.broadcast(req.POST.message, msg, *peers or PEERS)
+    return Broadcaster.broadcast("message", msg, *peers or PEERS)
 
 
 def bind_callback(reccord, func, *args, **kwargs):
@@ -36,20 +38,25 @@ def bind_callback(reccord, func, *args, **kwargs):
     # filter reccord to extract slp fields only for poh computation and create
     # consensus object
     fields = dict([k, v] for k, v in reccord.items() if k in slp_fields)
-    Consensus(
+    consensus = Consensus(
         dbapi.compute_poh("journal", **fields), func, *args, **kwargs
-    ).push(blockstamp)
+    )
+    consensus.push(blockstamp)
     # compute slp fields hash
     seed = json.dumps(fields, sort_keys=True, separators=(',', ':'))
     seed = seed.encode("utf-8")
-    msg = {
-        "consensus": {
-            "origin": f"http://{slp.PUBLIC_IP}:{slp.PORT}",
-            "blockstamp": blockstamp,
-            "hash": hashlib.sha256(seed).hexdigest(),
-        }
-    }
-    return send_message(msg)
+    # each peer gets its own challenge to send back with its consent
+    for challenge, peer in consensus.challenges.items():
+        send_message(
+            {
+                "consensus": {
+                    "origin": f"http://{slp.PUBLIC_IP}:{slp.PORT}",
+                    "blockstamp": blockstamp,
+                    "hash": hashlib.sha256(seed).hexdigest(),
+                    "challenge": challenge
+                }
+            }, peer
+        )
 
 
 def manage_hello(msg):
@@ -73,6 +80,8 @@ def manage_consensus(msg):
                 "consent": {
                     "blockstamp": blockstamp,
                     "poh": poh,
+                    "peer": f"http://{slp.PUBLIC_IP}:{slp.PORT}",
+                    "challenge": msg["consensus"].get("challenge", None),
                     "#": os.urandom(32).hex()
                 }
             },
@@ -87,84 +96,216 @@ def discovery(*peers, peer=None):
         "launching a discovery of %s to %s peers",
         msg["hello"]["peer"], len(peers)
     )
-    return Broadcaster.broadcast(req.POST.message, msg, *peers)
+    return Broadcaster.broadcast("message", msg, *peers)
 
 
 def prospect_peers(*peers):
     """
-    Recursive peer prospection from a peer selection.
+    Breadth-first peer prospection from a peer selection. All peers of a
+    prospection level are asked concurrently for their peer list.
     """
-    # exit prospetion if peer limit reached
-    if len(PEERS) > PEER_LIMIT:
-        return
+    return client.run(_prospect_peers(*peers))
+
 
-    slp.LOG.debug("prospecting %s peers", len(peers))
+async def _prospect_peers(*peers):
     me = f"http://{slp.PUBLIC_IP}:{slp.PORT}"
-    # for all new peer
-    for peer in set(peers) - set([me]):
-        # ask peer's peer list
-        resp = req.GET.peers(peer=peer, headers=slp.HEADERS)
-        # if it answerd
-        if isinstance(resp, list):
-            # add peer to peerlist and prospect peer's peer list
-            PEERS.update([peer])
-            peer_s_peer = set(resp)
-            # if peer is missing some known peer from here
-            if len(PEERS - peer_s_peer):
-                discovery(peer, peer=me)
-            # recursively prospect unknown peers from here
-            prospect_peers(*(peer_s_peer - PEERS))
+    limit = slp.JSON.get("prospect concurrency", 100)
+    visited = set([me])
+    # peer lists from peers that answered
+    answers = {}
+
+    async def ask(peer):
+        return peer, await client.request(
+            "GET", peer, "peers", headers=slp.HEADERS
+        )
+
+    level = set(peers) - visited
+    # exit prospetion if peer limit reached
+    while len(level) and len(PEERS) < PEER_LIMIT:
+        slp.LOG.debug("prospecting %s peers", len(level))
+        visited.update(level)
+        next_level = set()
+        for peer, resp in await client.gather(
+            *[ask(p) for p in level], limit=limit
+        ):
+            # if it answerd add peer to peerlist and prospect peer's peer
+            # list on next level, a single level can reach peer limit
+            if isinstance(resp, list) and (
+                peer in PEERS or len(PEERS) < PEER_LIMIT
+            ):
+                PEERS.update([peer])
+                answers[peer] = set(resp)
+                next_level.update(answers[peer])
+        level = next_level - visited
+    # send a single discovery to peers missing some known peers from here
+    uninformed = [
+        peer for peer, peer_s_peer in answers.items()
+        if len(PEERS - peer_s_peer - set([peer]))
+    ]
+    if len(uninformed):
+        discovery(*uninformed, peer=me)
+    return len(PEERS)
 
 
 class Consensus:
+    """
+    Quorum tracker on a reccord proof of history. Pending consensus expire
+    after `consensus ttl` seconds and at most `consensus size` of them are
+    kept, oldest ones being evicted first.
+    """
 
     MUTEX = threading.Lock()
-    JOB = {}
+    #: pending consensus by blockstamp, in push order
+    JOB = collections.OrderedDict()
+    #: latencies of last decisions in seconds
+    LATENCY = collections.deque(maxlen=100)
+    EXPIRED = 0
+    DECIDED = 0
 
     def __init__(self, poh, func, *args, **kwargs):
-        self.quorum = 0
-        self.aim = math.ceil(len(PEERS) / 2.)
+        peers = set(PEERS)
+        self.aim = math.ceil(len(peers) / 2.)
         self.poh = poh
         self.func = func
         self.args = args
         self.kwargs = kwargs
+        # challenge -> peer, a consent is counted only if it sends back the
+        # challenge given to a known peer
+        self.challenges = dict([os.urandom(16).hex(), p] for p in peers)
+        # voter -> poh, so a peer is counted once
+        self.votes = {}
+        self.start = time.time()
+
+    @property
+    def quorum(self):
+        return list(self.votes.values()).count(self.poh)
 
     def push(self, blockstamp):
         with Consensus.MUTEX:
             self._blockstamp = blockstamp
+            Consensus.JOB.pop(blockstamp, None)
             Consensus.JOB[blockstamp] = self
+            Consensus.evict()
 
     @staticmethod
-    def update(blockstamp, poh):
-        if blockstamp not in Consensus.JOB:
-            slp.LOG.info(
-                "no concesus initialized at blockstamp %s" % blockstamp
-            )
-            return None
-        with Consensus.MUTEX:
-            Consensus.JOB[blockstamp].quorum += (
-                1 if Consensus.JOB[blockstamp].poh == poh else 0
-            )
-            if Consensus.JOB[blockstamp].quorum >= \
-               Consensus.JOB[blockstamp].aim:
-                return Consensus.JOB.pop(blockstamp).trigger()
-                return True
+    def evict():
+        # has to be called with MUTEX acquired
+        ttl = slp.JSON.get("consensus ttl", 300)
+        size = slp.JSON.get("consensus size", 1000)
+        now = time.time()
+        while len(Consensus.JOB):
+            blockstamp, oldest = next(iter(Consensus.JOB.items()))
+            if len(Consensus.JOB) > size or now - oldest.start > ttl:
+                Consensus.JOB.popitem(last=False)
+                Consensus.EXPIRED += 1
+                slp.LOG.info("consensus at blockstamp %s expired", blockstamp)
             else:
+                break
+
+    @staticmethod
+    def update(blockstamp, poh, peer=None, nonce=None, challenge=None):
+        """
+        Register a vote. Voter is the known peer the challenge was sent to,
+        whatever the peer url claimed in the message, consents without a
+        valid challenge are not counted. While `consensus legacy consent`
+        is enabled, consents sent without challenge by peers not yet
+        upgraded are counted for the known peer they claim to be. `nonce`
+        only makes consent messages unique.
+        """
+        with Consensus.MUTEX:
+            Consensus.evict()
+            consensus = Consensus.JOB.get(blockstamp, None)
+            if consensus is None:
+                slp.LOG.info(
+                    "no concesus initialized at blockstamp %s" % blockstamp
+                )
+                return None
+            voter = consensus.challenges.get(challenge, None)
+            if challenge is None and peer in consensus.challenges.values() \
+               and slp.JSON.get("consensus legacy consent", True):
+                voter = peer
+            if voter is None:
+                slp.LOG.info(
+                    "consent from %s at blockstamp %s not authenticated",
+                    peer, blockstamp
+                )
+                return False
+            consensus.votes[voter] = poh
+            if consensus.quorum < consensus.aim:
                 return False
+            Consensus.JOB.pop(blockstamp)
+            Consensus.LATENCY.append(time.time() - consensus.start)
+            Consensus.DECIDED += 1
+        # callback is triggered outside of the mutex
+        return consensus.trigger()
 
     def trigger(self):
-        result = self.func(*self.args, *self.kwargs)
-        del Consensus.JOB[self._blockstamp]
+        result = self.func(*self.args, **self.kwargs)
         return result or "[triggered]"
 
+    @staticmethod
+    def stats():
+        with Consensus.MUTEX:
+            latency = list(Consensus.LATENCY)
+            return {
+                "pending": len(Consensus.JOB),
+                "expired": Consensus.EXPIRED,
+                "decided": Consensus.DECIDED,
+                "mean latency": round(
+                    sum(latency) / len(latency), 3
+                ) if len(latency) else None,
+                "max latency": round(max(latency), 3)
+                if len(latency) else None
+            }
+
+
+class Breaker:
+    """
+    Peer circuit breaker. It opens after `threshold` consecutive failures
+    and lets a trial request pass every `cooldown` seconds until peer
+    answers again.
+    """
+
+    def __init__(self, threshold=3, cooldown=60.):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+
+    def allow(self):
+        if self.opened is None:
+            return True
+        elif time.time() - self.opened >= self.cooldown:
+            # half open: one trial, failure re-opens for a cooldown
+            self.opened = time.time()
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened = time.time()
+
 
 class Broadcaster(threading.Thread):
     """
-    Daemon broadcast manager.
+    Daemon broadcast manager. Messages are dispatched to an outbox per peer
+    and endpoint, each one being delivered by its own coroutine on
+    `client` event loop, so a slow or dead peer only delays its own
+    messages.
     """
 
     JOB = queue.Queue()
     STOP = threading.Event()
+    #: per (peer, path) outboxes, delivery tasks and circuit breakers, only
+    #: accessed from client event loop
+    OUTBOX = {}
+    TASKS = {}
+    BREAKERS = {}
 
     def __init__(self, *args, **kwargs):
         threading.Thread.__init__(self)
@@ -173,26 +314,89 @@ class Broadcaster(threading.Thread):
         slp.LOG.info("Broadcaster %s set", id(self))
 
     @staticmethod
-    def broadcast(endpoint, msg, *peers):
-        Broadcaster.JOB.put([endpoint, msg, *peers])
+    def broadcast(path, msg, *peers):
+        """
+        Schedule a POST request of `msg` to `path` endpoint of all peers.
+        """
+        Broadcaster.JOB.put([path, msg, *peers])
 
     @staticmethod
     def stop():
         Broadcaster.STOP.set()
         Broadcaster.JOB.put([None, None])
 
+    @staticmethod
+    def enqueue(peer, path, msg):
+        # runs on client event loop
+        key = (peer, path)
+        outbox = Broadcaster.OUTBOX.get(key, None)
+        if outbox is None:
+            outbox = Broadcaster.OUTBOX[key] = asyncio.Queue(
+                slp.JSON.get("broadcast queue size", 100)
+            )
+            Broadcaster.BREAKERS[peer] = Broadcaster.BREAKERS.get(
+                peer, Breaker(
+                    slp.JSON.get("breaker threshold", 3),
+                    slp.JSON.get("breaker cooldown", 60.)
+                )
+            )
+            Broadcaster.TASKS[key] = asyncio.ensure_future(
+                Broadcaster.deliver(peer, path, outbox)
+            )
+        try:
+            outbox.put_nowait(msg)
+        except asyncio.QueueFull:
+            slp.LOG.error("outbox to %s/%s full, message dropped", peer, path)
+
+    @staticmethod
+    async def deliver(peer, path, outbox):
+        breaker = Broadcaster.BREAKERS[peer]
+        timeout = slp.JSON.get("broadcast timeout", 5.)
+        # messages waiting in outbox are sent in a single request if batch
+        # size is greater than 1, peer needs to understand batches
+        batch_size = slp.JSON.get("broadcast batch", 1)
+        try:
+            while True:
+                batch = [await outbox.get()]
+                while len(batch) < batch_size and not outbox.empty():
+                    batch.append(outbox.get_nowait())
+                if not breaker.allow():
+                    slp.LOG.info(
+                        "%s circuit open, %d message(s) dropped",
+                        peer, len(batch)
+                    )
+                    continue
+                try:
+                    resp = await client.request(
+                        "POST", peer, path, headers=slp.HEADERS,
+                        timeout=timeout, _jsonify=batch[0]
+                        if len(batch) == 1 else {"batch": batch}
+                    )
+                    # a peer not answering a JSON object is not a SLP node
+                    if not isinstance(resp, dict) or "error" in resp or \
+                       resp.get("status", 500) >= 500:
+                        breaker.failure()
+                    else:
+                        breaker.success()
+                    slp.LOG.info("%s: %s", peer, resp)
+                except Exception as error:
+                    breaker.failure()
+                    slp.LOG.error("delivery to %s failed: %r", peer, error)
+        finally:
+            # next message to this peer starts a new delivery task
+            Broadcaster.OUTBOX.pop((peer, path), None)
+            Broadcaster.TASKS.pop((peer, path), None)
+
     def run(self):
+        loop = client.loop()
         # controled infinite loop
         while not Broadcaster.STOP.is_set():
             try:
-                endpoint, msg, *peers = Broadcaster.JOB.get()
-                if isinstance(endpoint, req.EndPoint):
-                    for peer in peers or PEERS:
-                        slp.LOG.info(
-                            "%s", endpoint(
-                                peer=peer, _jsonify=msg,
-                                headers=slp.HEADERS
-                            )
+                path, msg, *peers = Broadcaster.JOB.get()
+                if path is not None:
+                    for peer in set(peers or PEERS):
+                        loop.call_soon_threadsafe(
+                            Broadcaster.enqueue, peer, path, msg
                         )
                 else:
                     slp.LOG.info("Broadcaster %s clean exit", id(self))
@@ -201,14 +405,29 @@ class Broadcaster(threading.Thread):
 
 
 class Topology(threading.Thread):
+    """
+    SLP peer determination from blockchain peers. Probe results are cached
+    in `topology.json` and a peer is probed again only when its result is
+    older than `topology ttl` seconds.
+    """
 
     PEERS = set([])
+    STOP = threading.Event()
+    #: {peer: {"alive": bool, "checked": unix time}}
+    CACHE = {}
 
     def __init__(self, *args, **kwargs):
         threading.Thread.__init__(self)
-        peers = slp.loadJson("topology.json")
-        if peers:
-            Topology.PEERS.update(peers)
+        cache = slp.loadJson("topology.json")
+        # former topology.json was a peer list, consider it as expired
+        if isinstance(cache, list):
+            cache = dict([p, {"alive": True, "checked": 0}] for p in cache)
+        Topology.CACHE.update(cache)
+        ttl = slp.JSON.get("topology ttl", 3600)
+        Topology.PEERS.update(
+            peer for peer, probe in Topology.CACHE.items()
+            if probe["alive"] and time.time() - probe["checked"] < ttl
+        )
         self.daemon = True
         self.start()
         slp.LOG.info("Topology %s set", id(self))
@@ -217,21 +436,48 @@ class Topology(threading.Thread):
     def stop():
         Topology.STOP.set()
 
+    @staticmethod
+    async def probe(*peers):
+        timeout = slp.JSON.get("probe timeout", 2.)
+
+        async def check(peer):
+            resp = await client.request(
+                "HEAD", peer, "message", headers=slp.HEADERS, timeout=timeout
+            )
+            return resp.get("status", 400) == 200
+
+        return await client.gather(
+            *[check(peer) for peer in peers],
+            limit=slp.JSON.get("prospect concurrency", 100)
+        )
+
     def run(self):
+        Topology.STOP.clear()
+        ttl = slp.JSON.get("topology ttl", 3600)
         # idea is to prospect for a all peers
-        for peer in set([
-            "http://%s:5200" % p["ip"] for p in req.GET.api.peers(
-                orderBy="height:desc", peer=slp.JSON["api peer"],
+        candidates = set([
+            "http://%s:5200" % p["ip"] for p in client.get(
+                slp.JSON["api peer"], "api", "peers", orderBy="height:desc",
                 headers=slp.HEADERS
             ).get("data", [])
-        ]):
-            slp.LOG.debug("checking %s", peer)
-            if req.HEAD.message(peer=peer, headers=slp.HEADERS).get(
-                "status", 400
-            ) == 200:
+        ])
+        # probe peers never checked or with an expired result
+        now = time.time()
+        peers = [
+            peer for peer in candidates | set(Topology.CACHE)
+            if now - Topology.CACHE.get(peer, {}).get("checked", 0) >= ttl
+        ]
+        slp.LOG.debug("checking %d peers", len(peers))
+        for peer, alive in zip(peers, client.run(Topology.probe(*peers))):
+            Topology.CACHE[peer] = {"alive": alive, "checked": now}
+            if alive:
                 Topology.PEERS.update([peer])
                 slp.LOG.info("SLP peer found: %s", peer)
-        slp.dumpJson(list(Topology.PEERS), "topology.json")
+            else:
+                Topology.PEERS.discard(peer)
+        if Topology.STOP.is_set():
+            return
+        slp.dumpJson(Topology.CACHE, "topology.json")
         slp.LOG.info(
             "topology determination done (%d peers)", len(Topology.PEERS)
         )
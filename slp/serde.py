@@ -6,40 +6,53 @@ import struct
 import binascii
 
 
+#: struct codecs compiled once per format string
+CODECS = {}
+BYTE = struct.Struct("<B")
+
+
+def _codec(slp_type, i, height=None, suffix=""):
+    "return compiled struct of a milestone slp format"
+    fmt = slp.JSON.ask("slp formats", height)[slp_type][i] + suffix
+    codec = CODECS.get(fmt, None)
+    if codec is None:
+        codec = CODECS[fmt] = struct.Struct(fmt)
+    return codec
+
+
 def _pack_varia(*varias):
     "pack a list of variable length strings"
-    serial = b""
+    serial = []
     for varia in [v.encode() for v in varias]:
-        len_v = len(varia)
-        serial += struct.pack("<B%ds" % len_v, len_v, varia)
-    return serial
+        serial += [BYTE.pack(len(varia)), varia]
+    return b"".join(serial)
+
+
+def _read_varia(view, n):
+    "read a variable length string from memoryview at offset n"
+    size = view[n]
+    n += 1
+    if n + size > len(view):
+        raise struct.error("variable length string out of data")
+    return str(view[n:n+size], "utf-8"), n + size
 
 
 def _unpack_varia(data, *keys):
     "unpack a list of variable length string associated to specific keys"
     result = {}
-    n = 0
-    i = struct.calcsize("<B")
+    view, n = memoryview(data), 0
     for key in keys:
-        size, = struct.unpack("<B", data[n:n+i])
-        n += i
-        value, = struct.unpack("<%ss" % size, data[n:n+size])
-        result[key] = value.decode()
-        n += size
+        result[key], n = _read_varia(view, n)
     return result
 
 
 def _unpack_meta(data):
     "unpack metadata from string and build the mapping"
     result = []
-    n = 0
-    i = struct.calcsize("<B")
-    while n < len(data) - 1:
-        size, = struct.unpack("<B", data[n:n+i])
-        n += i
-        value, = struct.unpack("<%ss" % size, data[n:n+size])
-        result.append(value.decode())
-        n += size
+    view, n = memoryview(data), 0
+    while n < len(view) - 1:
+        value, n = _read_varia(view, n)
+        result.append(value)
     return dict(zip(result[0::2], result[1::2]))
 
 
@@ -55,9 +68,8 @@ def _match_smartbridge(smartbridge):
 def pack_slp1_genesis(
     de, qt, sy, na, du="", no="", pa=False, mi=False, height=None
 ):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP1][0]
-    fixed = struct.pack(
-        fixed_fmt, slp.INPUT_TYPES["GENESIS"],
+    fixed = _codec(slp.SLP1, 0, height).pack(
+        slp.INPUT_TYPES["GENESIS"],
         int(de), int(qt), bool(pa), bool(mi)
     )
     varia = _pack_varia(sy, na, du, no)
@@ -65,42 +77,43 @@ def pack_slp1_genesis(
 
 
 def pack_slp1_fungible(tb, id, qt, no="", height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP1][1]
-    fixed = struct.pack(
-        fixed_fmt, slp.INPUT_TYPES[tb], binascii.unhexlify(id), float(qt)
+    fixed = _codec(slp.SLP1, 1, height).pack(
+        slp.INPUT_TYPES[tb], binascii.unhexlify(id), float(qt)
     )
     varia = _pack_varia(no)
     return slp.SLP1 + "://" + binascii.hexlify(fixed).decode() + varia.decode()
 
 
 def pack_slp1_non_fungible(tb, id, no="", height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP1][2]
-    fixed = struct.pack(fixed_fmt, slp.INPUT_TYPES[tb], binascii.unhexlify(id))
+    fixed = _codec(slp.SLP1, 2, height).pack(
+        slp.INPUT_TYPES[tb], binascii.unhexlify(id)
+    )
     varia = _pack_varia(no)
     return slp.SLP1 + "://" + binascii.hexlify(fixed).decode() + varia.decode()
 
 
 # -- SLP2 SERIALIZATION --
 def pack_slp2_genesis(sy, na, du="", no="", pa=False, height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP2][0]
-    fixed = struct.pack(fixed_fmt, slp.INPUT_TYPES["GENESIS"], bool(pa))
+    fixed = _codec(slp.SLP2, 0, height).pack(
+        slp.INPUT_TYPES["GENESIS"], bool(pa)
+    )
     varia = _pack_varia(sy, na, du, no)
     return slp.SLP2 + "://" + binascii.hexlify(fixed).decode() + varia.decode()
 
 
 def pack_slp2_non_fungible(tp, id, no="", height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP2][1]
-    fixed = struct.pack(fixed_fmt, slp.INPUT_TYPES[tp], binascii.unhexlify(id))
+    fixed = _codec(slp.SLP2, 1, height).pack(
+        slp.INPUT_TYPES[tp], binascii.unhexlify(id)
+    )
     varia = _pack_varia(no)
     return slp.SLP2 + "://" + binascii.hexlify(fixed).decode() + varia.decode()
 
 
 def pack_slp2_addmeta(id, height=None, **data):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP2][1]
     metadata = sorted(data.items(), key=lambda i: len("%s%s" % i))
     # pack fixed size data
-    fixed = struct.pack(
-        fixed_fmt, slp.INPUT_TYPES["ADDMETA"], binascii.unhexlify(id)
+    fixed = _codec(slp.SLP2, 1, height).pack(
+        slp.INPUT_TYPES["ADDMETA"], binascii.unhexlify(id)
     )
     # smartbridge size - header size - 2*(fixed size + chunk size)
     spaceleft = 256 - len("_slp2://") - 2*(len(fixed) + 1)
@@ -123,16 +136,15 @@ def pack_slp2_addmeta(id, height=None, **data):
     return [
         slp.SLP2 + "://" + (
             binascii.hexlify(
-                fixed + struct.pack("<B", result.index(serial) + 1)
+                fixed + BYTE.pack(result.index(serial) + 1)
             ).decode() + serial.decode()
         ) for serial in result
     ]
 
 
 def pack_slp2_voidmeta(id, tx, height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP2][2]
-    fixed = struct.pack(
-        fixed_fmt, slp.INPUT_TYPES["VOIDMETA"],
+    fixed = _codec(slp.SLP2, 2, height).pack(
+        slp.INPUT_TYPES["VOIDMETA"],
         binascii.unhexlify(id), binascii.unhexlify(tx)
     )
     return slp.SLP2 + "://" + binascii.hexlify(fixed).decode()
@@ -140,12 +152,12 @@ def pack_slp2_voidmeta(id, tx, height=None):
 
 # -- SLP1 DESERIALIZATION --
 def unpack_slp1_genesis(data, height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP1][0]
-    n = int(struct.calcsize(fixed_fmt) * 2)
+    codec = _codec(slp.SLP1, 0, height)
+    n = codec.size * 2
     fixed = binascii.unhexlify(data[:n])
     varia = data[n:].encode()
     result = dict(
-        zip(["tp", "de", "qt", "pa", "mi"], struct.unpack(fixed_fmt, fixed)),
+        zip(["tp", "de", "qt", "pa", "mi"], codec.unpack(fixed)),
         **_unpack_varia(varia, "sy", "na", "du", "no")
     )
     result["tp"] = slp.TYPES_INPUT[result["tp"]]
@@ -153,12 +165,12 @@ def unpack_slp1_genesis(data, height=None):
 
 
 def unpack_slp1_fungible(data, height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP1][1]
-    n = int(struct.calcsize(fixed_fmt) * 2)
+    codec = _codec(slp.SLP1, 1, height)
+    n = codec.size * 2
     fixed = binascii.unhexlify(data[:n])
     varia = data[n:].encode()
     result = dict(
-        zip(["tp", "id", "qt"], struct.unpack(fixed_fmt, fixed)),
+        zip(["tp", "id", "qt"], codec.unpack(fixed)),
         **_unpack_varia(varia, "no")
     )
     result["id"] = binascii.hexlify(result["id"]).decode()
@@ -167,12 +179,12 @@ def unpack_slp1_fungible(data, height=None):
 
 
 def unpack_slp1_non_fungible(data, height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP1][2]
-    n = int(struct.calcsize(fixed_fmt) * 2)
+    codec = _codec(slp.SLP1, 2, height)
+    n = codec.size * 2
     fixed = binascii.unhexlify(data[:n])
     varia = data[n:].encode()
     result = dict(
-        zip(["tp", "id"], struct.unpack(fixed_fmt, fixed)),
+        zip(["tp", "id"], codec.unpack(fixed)),
         **_unpack_varia(varia, "no")
     )
     result["id"] = binascii.hexlify(result["id"]).decode()
@@ -182,12 +194,12 @@ def unpack_slp1_non_fungible(data, height=None):
 
 # -- SLP2 DESERIALIZATION --
 def unpack_slp2_genesis(data, height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP2][0]
-    n = int(struct.calcsize(fixed_fmt) * 2)
+    codec = _codec(slp.SLP2, 0, height)
+    n = codec.size * 2
     fixed = binascii.unhexlify(data[:n])
     varia = data[n:].encode()
     result = dict(
-        zip(["tp", "pa"], struct.unpack(fixed_fmt, fixed)),
+        zip(["tp", "pa"], codec.unpack(fixed)),
         **_unpack_varia(varia, "sy", "na", "du", "no")
     )
     result["tp"] = slp.TYPES_INPUT[result["tp"]]
@@ -195,12 +207,12 @@ def unpack_slp2_genesis(data, height=None):
 
 
 def unpack_slp2_non_fungible(data, height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP2][1]
-    n = int(struct.calcsize(fixed_fmt) * 2)
+    codec = _codec(slp.SLP2, 1, height)
+    n = codec.size * 2
     fixed = binascii.unhexlify(data[:n])
     varia = data[n:].encode()
     result = dict(
-        zip(["tp", "id"], struct.unpack(fixed_fmt, fixed)),
+        zip(["tp", "id"], codec.unpack(fixed)),
         **_unpack_varia(varia, "no")
     )
     result["id"] = binascii.hexlify(result["id"]).decode()
@@ -209,12 +221,12 @@ def unpack_slp2_non_fungible(data, height=None):
 
 
 def unpack_slp2_addmeta(data, height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP2][1] + "B"
-    n = int(struct.calcsize(fixed_fmt) * 2)
+    codec = _codec(slp.SLP2, 1, height, suffix="B")
+    n = codec.size * 2
     fixed = binascii.unhexlify(data[:n])
     varia = data[n:].encode()
     result = dict(
-        zip(["tp", "id", "ch"], struct.unpack(fixed_fmt, fixed)),
+        zip(["tp", "id", "ch"], codec.unpack(fixed)),
         **{
             "dt": json.dumps(
                 _unpack_meta(varia), sort_keys=True, separators=(",", ":")
@@ -227,10 +239,10 @@ def unpack_slp2_addmeta(data, height=None):
 
 
 def unpack_slp2_voidmeta(data, height=None):
-    fixed_fmt = slp.JSON.ask("slp formats", height)[slp.SLP2][2]
+    codec = _codec(slp.SLP2, 2, height)
     fixed = binascii.unhexlify(data)
     result = dict(
-        zip(["tp", "id", "tx"], struct.unpack(fixed_fmt, fixed)),
+        zip(["tp", "id", "tx"], codec.unpack(fixed)),
     )
     result["id"] = binascii.hexlify(result["id"]).decode()
     result["tx"] = binascii.hexlify(result["tx"]).decode()
@@ -297,9 +309,8 @@ def pack_slp2(*args, **kwargs):
         raise Exception("Bad smartbridge size (>256)")
 
 
-def unpack_slp(smartbridge, height=None):
+def _unpack(smartbridge, height, slp_types):
     slp_type, data = _match_smartbridge(smartbridge)
-    slp_types = slp.JSON.ask("slp types", height)
     if slp_type not in slp_types:
         raise Exception(
             "Expecting %s contract, not %s" % (
@@ -308,3 +319,22 @@ def unpack_slp(smartbridge, height=None):
             )
         )
     return MAP[slp_type[1:]][data[:2]](data, height)
+
+
+def unpack_slp(smartbridge, height=None):
+    return _unpack(smartbridge, height, slp.JSON.ask("slp types", height))
+
+
+def unpack_many(smartbridges, height=None):
+    """
+    Unpack smartbridges from a same block. Returns a list of contracts with
+    `False` where a smartbridge could not be unpacked.
+    """
+    slp_types = slp.JSON.ask("slp types", height)
+    result = []
+    for smartbridge in smartbridges:
+        try:
+            result.append(_unpack(smartbridge, height, slp_types))
+        except Exception:
+            result.append(False)
+    return result
@@ -14,23 +14,31 @@ from bson import Decimal128
 
 def manage(contract, **options):
     """
-    Dispatch the contract according to its type.
+    Dispatch the contract according to its type. Contract is applied as an
+    atomic unit: state modifications and legit flag are committed together.
+    A contract whose application raises is rejected, see `dbapi.abort`.
     """
     try:
         assert dbapi.db is not None
         assert contract.get("legit", False) is None
-        result = getattr(
-            sys.modules[__name__], "apply_%s" % contract["tp"].lower()
-        )(contract, **options)
-        if result is False:
-            dbapi.db.rejected.insert_one(contract)
-        return result
     except AssertionError:
         slp.LOG.error("Contract %s already applied", contract)
-    except AttributeError:
-        slp.LOG.error("Unknown contract type %s", contract["tp"])
-    except Exception:
+        return None
+    apply = getattr(
+        sys.modules[__name__], "apply_%s" % contract["tp"].lower(), None
+    )
+    try:
+        if apply is None:
+            raise Exception(f"Unknown contract type {contract['tp']}")
+        with dbapi.atomic():
+            result = apply(contract, **options)
+            if result is False:
+                dbapi.reject(contract)
+        return result
+    except Exception as error:
         slp.LOG.error("SLP1 exec - Error occured: %s", traceback.format_exc())
+        # modifications are rolled back, contract is not left unapplied
+        return dbapi.abort(contract, error)
 
 
 def apply_genesis(contract, **options):
@@ -65,7 +73,7 @@ def apply_genesis(contract, **options):
         minted = _decimal128(0.) if contract.get("mi", False) else globalSupply
         # add new contract and new owner wallet into database
         check = [
-            dbapi.db.contracts.insert_one(
+            dbapi.insert_contract(
                 dict(
                     tokenId=tokenId, height=contract["height"],
                     index=contract["index"], type=slp.SLP1,
@@ -76,7 +84,7 @@ def apply_genesis(contract, **options):
                     crossed=_decimal128(0.)
                 )
             ),
-            dbapi.db.slp1.insert_one(
+            dbapi.insert_slp1_wallet(
                 dict(
                     address=contract["emitter"], tokenId=tokenId,
                     blockStamp=f"{contract['height']}#{contract['index']}",
@@ -73,23 +73,31 @@ def _receiver_check(address, tokenId, must_exist=True):
 
 def manage(contract, **options):
     """
-    Dispatch the contract according to its type.
+    Dispatch the contract according to its type. Contract is applied as an
+    atomic unit: state modifications and legit flag are committed together.
+    A contract whose application raises is rejected, see `dbapi.abort`.
     """
     try:
         assert dbapi.db is not None
         assert contract.get("legit", False) is None
-        result = getattr(
-            sys.modules[__name__], "apply_%s" % contract["tp"].lower()
-        )(contract, **options)
-        if result is False:
-            dbapi.db.rejected.insert_one(contract)
-        return result
     except AssertionError:
         slp.LOG.error("Contract %s already applied", contract)
-    except AttributeError:
-        slp.LOG.error("Unknown contract type %s", contract["tp"])
-    except Exception:
+        return None
+    apply = getattr(
+        sys.modules[__name__], "apply_%s" % contract["tp"].lower(), None
+    )
+    try:
+        if apply is None:
+            raise Exception(f"Unknown contract type {contract['tp']}")
+        with dbapi.atomic():
+            result = apply(contract, **options)
+            if result is False:
+                dbapi.reject(contract)
+        return result
+    except Exception as error:
         slp.LOG.error("SLP2 exec - Error occured: %s", traceback.format_exc())
+        # modifications are rolled back, contract is not left unapplied
+        return dbapi.abort(contract, error)
 
 
 def apply_genesis(contract, **options):
@@ -112,7 +120,7 @@ def apply_genesis(contract, **options):
     else:
         check = [
             # add new contract
-            dbapi.db.contracts.insert_one(
+            dbapi.insert_contract(
                 dict(
                     tokenId=tokenId, height=contract["height"],
                     index=contract["index"], type=slp.SLP2,
@@ -122,7 +130,7 @@ def apply_genesis(contract, **options):
                 )
             ),
             # add new owner wallet
-            dbapi.db.slp2.insert_one(
+            dbapi.insert_slp2_wallet(
                 dict(
                     address=contract["emitter"], tokenId=tokenId,
                     blockStamp=f"{contract['height']}#{contract['index']}",
@@ -166,7 +174,7 @@ def apply_newowner(contract, **options):
         check = []
         if receiver is None:
             check.append(
-                dbapi.db.slp2.insert_one(
+                dbapi.insert_slp2_wallet(
                     dict(
                         address=contract["receiver"], tokenId=tokenId,
                         blockStamp=blockstamp, owner=True, metadata=b""
@@ -294,7 +302,7 @@ def apply_authmeta(contract, **options):
         return dbapi.set_legit({"_id": contract["_id"]}, False)
     else:
         return dbapi.set_legit(
-            contract, dbapi.db.slp2.insert_one(
+            contract, dbapi.insert_slp2_wallet(
                 dict(
                     address=contract["receiver"], tokenId=tokenId,
                     blockStamp=blockstamp, owner=False, metadata=b""
@@ -417,7 +425,8 @@ def apply_revokemeta(contract, **options):
         return dbapi.set_legit({"_id": contract["_id"]}, False)
     else:
         return dbapi.set_legit(
-            contract, dbapi.db.slp2.delete_one(receiver)
+            contract,
+            dbapi.delete_slp2_wallet(receiver["address"], tokenId)
         )
 
 
@@ -455,12 +464,12 @@ def apply_clone(contract, **options):
         )
         # get all metadata
         metadata = b""
-        for document in dbapi.db.slp2.find({"tokenId": tokenId}):
+        for document in dbapi.find_slp2_wallets(tokenId=tokenId):
             metadata += document["metadata"]
 
         check = [
             # add new contract
-            dbapi.db.contracts.insert_one(
+            dbapi.insert_contract(
                 dict(
                     tokenId=new_tokenId, height=contract["height"],
                     index=contract["index"], type=slp.SLP2,
@@ -470,7 +479,7 @@ def apply_clone(contract, **options):
                 )
             ),
             # add new owner wallet with the whome metadata
-            dbapi.db.slp2.insert_one(
+            dbapi.insert_slp2_wallet(
                 dict(
                     address=emitter["address"], tokenId=new_tokenId,
                     blockStamp=f"{contract['height']}#{contract['index']}",
@@ -2,12 +2,191 @@
 
 import os
 import slp
-import random
+import time
 import traceback
 import threading
+import collections
+import concurrent.futures
 
 from usrv import req
-from slp import dbapi, chain
+from slp import dbapi, chain, client
+
+
+def replay(batch=None, pending=False):
+    """
+    Rebuild contracts, slp1 and slp2 collections from journal. Contracts are
+    applied in journal order on an in-memory state, collections being empty
+    (see `app.clean`), and state is written with bulk inserts and bulk legit
+    updates every `batch` contracts.
+
+    If `pending` is True, only contracts not applied yet (legit is None) are
+    replayed on current state. Because legit flags are committed together
+    with state modifications, it resumes contract execution after a crash.
+    """
+    batch = batch or slp.JSON.get("replay batch", 10000)
+    filter = {"legit": None} if pending else {}
+    total = dbapi.db.journal.count_documents(filter) if pending else \
+        dbapi.db.journal.estimated_document_count()
+    count, flushed, height, start = 0, 0, None, time.time()
+    with dbapi.StateCache(authoritative=not pending) as state:
+        for contract in dbapi.db.journal.find(filter).sort("_id", 1) \
+                .batch_size(batch):
+            # flush state at block boundaries
+            if contract["height"] != height:
+                if count - flushed >= batch:
+                    state.flush()
+                    flushed = count
+                    slp.LOG.info(
+                        "Replayed %d/%d contracts (%.1f contracts/s)",
+                        count, total, count / max(time.time() - start, 1e-3)
+                    )
+                height = contract["height"]
+            # GENESIS reccords are needed by next contracts
+            if contract["tp"] == "GENESIS":
+                state.genesis.setdefault(contract["id"], dict(contract))
+            contract["legit"] = None
+            chain.BlockParser.apply(contract)
+            count += 1
+    slp.LOG.info(
+        "Journal replay done: %d contracts in %.1f s",
+        count, time.time() - start
+    )
+    return count
+
+
+def rebuild(mark=None):
+    """
+    Rebuild state collections replaying the whole journal. `rebuild` flag
+    is kept in `mark` until replay succeeds.
+    """
+    if mark is not None:
+        mark.update(rebuild=True)
+        mark.save(force=True)
+    dbapi.drop_state()
+    count = replay()
+    if mark is not None:
+        mark.pop("rebuild")
+        mark.save(force=True)
+    return count
+
+
+class Prefetcher:
+    """
+    Bounded block download pipeline. It keeps `window` block pages, and the
+    transactions of their blocks, in flight across a peer selection and
+    returns them in strict page order.
+    """
+
+    def __init__(self, page, peers, window=4, limit=100, min_height=0):
+        self.page = page
+        self.peers = list(peers)
+        self.window = max(1, window)
+        self.limit = limit
+        self.min_height = min_height
+        self.pending = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.window * 4, thread_name_prefix="prefetch"
+        )
+        self._cycle = 0
+        self.fill()
+
+    def pick_peer(self):
+        # peer selection may have been emptied by drop_peer
+        if not len(self.peers):
+            self.peers = [slp.JSON["api peer"]]
+        self._cycle += 1
+        return self.peers[self._cycle % len(self.peers)]
+
+    def drop_peer(self, peer):
+        if peer in self.peers:
+            self.peers.remove(peer)
+        if len(self.peers) <= 1:
+            try:
+                peers = chain.select_peers()[:slp.JSON.get("sync peers", 5)]
+            except Exception as error:
+                slp.LOG.error("%r", error)
+                peers = []
+            self.peers = peers or self.peers or [slp.JSON["api peer"]]
+
+    def submit(self, page, peer=None):
+        peer = peer or self.pick_peer()
+        return [page, peer, self.executor.submit(self.fetch, page, peer)]
+
+    def fill(self):
+        while len(self.pending) < self.window:
+            self.pending.append(self.submit(self.page))
+            self.page += 1
+
+    def fetch(self, page, peer):
+        """
+        Download a block page and schedule transaction download for all blocks
+        having transactions. It does not wait for transactions so the pool
+        can not deadlock on itself.
+        """
+        resp = chain.api_get(
+            peer, "api", "blocks", page=page, limit=self.limit,
+            orderBy="height:asc", headers=slp.HEADERS
+        )
+        if resp.get("status", False) == 200:
+            blocks = [
+                b for b in resp.get("data", [])
+                if b["transactions"] > 0 and b["height"] > self.min_height
+            ]
+            # try to get all transactions of the page with range queries
+            grouped = {}
+            if len(blocks) and slp.JSON.get("bulk transactions", True):
+                grouped = chain.get_range_transactions(
+                    blocks[0]["height"], blocks[-1]["height"], peer
+                ) or {}
+            for block in blocks:
+                # integrity is checked per block by chain.parse_block,
+                # download transactions block by block if range query missed
+                # some of them
+                tx_list = grouped.get(block["id"], [])
+                if len(tx_list) == int(block["transactions"]):
+                    block["tx_list"] = tx_list
+                else:
+                    block["tx_list"] = self.executor.submit(
+                        chain.get_block_transactions, block["id"], peer
+                    )
+        return resp
+
+    def next(self):
+        """
+        Wait for the oldest page in flight. Returns page number, peer used and
+        the api response or `None` if page has to be downloaded again.
+        """
+        page, peer, future = self.pending[0]
+        try:
+            resp = future.result()
+        except Exception as error:
+            slp.LOG.error("%r", error)
+            resp = {}
+        if resp.get("status", False) != 200:
+            slp.LOG.info("No block from %s", peer)
+            self.drop_peer(peer)
+            self.pending[0] = self.submit(page)
+            return page, peer, None
+        self.pending.popleft()
+        self.fill()
+        # resolve transaction downloads, on failure BlockParser will fetch
+        # transactions by itself
+        for block in resp.get("data", []):
+            tx_list = block.pop("tx_list", None)
+            if isinstance(tx_list, list):
+                block["tx_list"] = tx_list
+            elif tx_list is not None:
+                try:
+                    block["tx_list"] = tx_list.result()
+                except Exception as error:
+                    slp.LOG.error("%r", error)
+        return page, peer, resp
+
+    def close(self):
+        for page, peer, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
 
 class Processor(threading.Thread):
@@ -24,37 +203,65 @@ class Processor(threading.Thread):
     def stop():
         Processor.STOP.set()
 
+    @staticmethod
+    def recover(mark):
+        """
+        Rebuild databases if marker found or if contracts were left
+        unapplied on a database without transactions, state being maybe
+        partially written. Else apply contracts left unapplied by an
+        unexpected stop. Returns `False` on failure.
+        """
+        try:
+            if mark.get("rebuild", False) or (
+                not dbapi.transactional() and
+                dbapi.db.journal.find_one({"legit": None}) is not None
+            ):
+                slp.LOG.info("Rebuilding databases from journal")
+                rebuild(mark)
+            else:
+                replay(pending=True)
+        except Exception as error:
+            slp.LOG.error("State recovery failed: %r", error)
+            slp.LOG.debug("traceback data:\n%s", traceback.format_exc())
+            return False
+        return True
+
     def run(self):
-        timeout = req.EndPoint.timeout
-        req.EndPoint.timeout = 30
+        timeout = req.EndPoint.timeout, client.TIMEOUT
+        req.EndPoint.timeout = client.TIMEOUT = 30
         # subscribe to blockchain webhook if not already done
         if not chain.subscribed():
             chain.subscribe()
         # load last processing mark if any
         markfolder = os.path.join(slp.ROOT, ".json")
         markname = f"{slp.JSON['database name']}.mark"
-        mark = slp.loadJson(markname, markfolder)
-        # rebuild databases if marker found
-        if mark.get("rebuild", False):
-            slp.LOG.info("Rebuilding databases from journal")
-            for contract in dbapi.db.journal.find({}).sort("_id", 1):
-                contract["legit"] = None
-                chain.BlockParser.apply(contract)
-            mark.pop("rebuild")
-            slp.dumpJson(mark, markname, markfolder)
-        # get last good peer if any else choose a random one
-        peers = chain.select_peers()
-        peer = mark.get("peer", random.choice(peers))
+        mark = chain.Checkpoint(markname, markfolder)
+        # state has to be consistent with journal before sync starts, retry
+        # until database answers
+        while not Processor.recover(mark):
+            if Processor.STOP.wait(slp.JSON.get("apply retry delay", 5)):
+                req.EndPoint.timeout, client.TIMEOUT = timeout
+                slp.LOG.info("Processor %d task exited", id(self))
+                return
+        # get last good peer if still among the best ones else the best one
+        peers = chain.select_peers()[:slp.JSON.get("sync peers", 5)]
+        peer = mark.get("peer", None)
+        if peer not in peers:
+            peer = peers[0]
         # determine where to start
         start_height = max(
             min(list(slp.JSON["milestones"].keys())[1:]),
-            mark.get("last parsed block", 0)
+            mark.resume_height()
         )
         last_reccord = list(
             dbapi.db.journal.find().sort("height", -1).limit(1)
         )
         if len(last_reccord):
             start_height = max(last_reccord[0]["height"], start_height)
+        # rewind below webhook blocks that could not be queued
+        missed = mark.get("missed block", None)
+        if missed is not None:
+            start_height = min(start_height, missed - 1)
         block_per_page = 100
         page = max(1, start_height // block_per_page - 1)
 
@@ -62,19 +269,23 @@ class Processor(threading.Thread):
         last_parsed = start_height
 
         # controled infinite loop
-        chain.BlockParser()
+        chain.BlockParser(mark)
+        chain.Feeder(mark)
         Processor.STOP.clear()
+        prefetch = Prefetcher(
+            page, [peer] + [p for p in peers if p != peer],
+            window=slp.JSON.get("sync window", 4), limit=block_per_page,
+            min_height=start_height
+        )
+        fetched, start_time = 0, time.time()
         while not Processor.STOP.is_set():
             try:
+                page, peer, blocks = prefetch.next()
 
-                blocks = req.GET.api.blocks(
-                    peer=peer, page=page, limit=block_per_page,
-                    orderBy="height:asc", headers=slp.HEADERS
-                )
-
-                if blocks.get("status", False) == 200:
-                    mark = {"peer": peer}
+                if blocks is not None:
+                    mark.update(peer=peer)
                     next_page = blocks.get("meta", {}).get("next", False)
+                    fetched += len(blocks.get("data", []))
 
                     blocks = [
                         b for b in blocks.get("data", [])
@@ -82,34 +293,36 @@ class Processor(threading.Thread):
                            b["height"] > last_parsed
                     ]
 
-                    slp.LOG.info(
-                        "Fetching %d blocks from page %d", len(blocks), page
-                    )
-
                     if len(blocks):
                         for block in blocks:
-                            chain.BlockParser.JOB.put(block)
-                            mark["last parsed block"] = block["height"]
-                            slp.dumpJson(mark, markname, markfolder)
+                            # blocks here if BlockParser queue is full
+                            if not chain.enqueue(block, Processor.STOP):
+                                break
                             last_parsed = block["height"]
+                        mark.update(**{"last parsed block": last_parsed})
+                        if missed is not None and last_parsed >= missed:
+                            mark.pop("missed block")
+                            missed = None
+                    # checkpoint once per page at most
+                    mark.save()
+
+                    slp.LOG.info(
+                        "Fetched %d blocks from page %d (%.1f blocks/s)",
+                        len(blocks), page,
+                        fetched / max(time.time() - start_time, 1e-3)
+                    )
+                    slp.LOG.debug("block pipeline: %s", chain.gauges())
 
                     if next_page is None:
                         slp.LOG.info("End of block pages reached")
                         Processor.stop()
-                    else:
-                        page += 1
-
-                else:
-                    slp.LOG.info("No block from %s", peer)
-                    if peer in peers:
-                        peers.remove(peer)
-                    if len(peers) <= 1:
-                        peers = chain.select_peers()
-                    peer = random.choice(peers)
 
             except Exception as error:
                 slp.LOG.error("%r", error)
                 slp.LOG.debug("traceback data:\n%s", traceback.format_exc())
 
-        req.EndPoint.timeout = timeout
+        prefetch.close()
+        mark.save(force=True)
+        chain.save_peer_stats()
+        req.EndPoint.timeout, client.TIMEOUT = timeout
         slp.LOG.info("Processor %d task exited", id(self))